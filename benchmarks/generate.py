@@ -0,0 +1,209 @@
+"""Generate a deterministic synthetic cohort for the benchmarks.
+
+The same seed and sizes always give the same data:
+
+- ``fastq/``: gzipped paired-end reads named like Illumina runs
+  (``S0001_R1_001.fastq.gz``), as expected by ``create_manifest_file.py``.
+- ``table.biom`` and ``table.qza``: feature table of samples x features with
+  the requested density.
+- ``taxonomy.qza``: FeatureData[Taxonomy] of the features.
+- ``otu_tax.biom``: the table collapsed at species level, as written by the
+  ``collapse_tax`` and ``extract_biom`` rules.
+- ``taxonpath.json``, ``names.json``: taxonomy database in the layout of the
+  files downloaded by ``download_names_and_taxonpath``.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+ranks = ['k', 'p', 'c', 'o', 'f', 'g', 's']
+
+rank_names = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus',
+              'Species']
+
+bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+complement = bytes.maketrans(b"ACGT", b"TGCA")
+
+
+def make_sequences(rng, n, length=250):
+    """Random ASV sequences, with md5 feature ids as written by DADA2."""
+    seqs = [bases[rng.integers(0, 4, length)].tobytes().decode()
+            for _ in range(n)]
+    ids = [hashlib.md5(s.encode()).hexdigest() for s in seqs]
+    return ids, seqs
+
+
+def make_taxonomy(rng, n_species):
+    """Random taxonomy tree.
+
+    Returns
+    -------
+    names : dict
+        Taxonomy id -> name.
+    taxonpath : dict
+        Taxonomy id -> lineage, a dict of rank -> taxonomy id (``''`` below
+        the rank of the taxon).
+    species : list of list
+        Names of the lineage of every species, kingdom first.
+    """
+    names = {}
+    taxonpath = {}
+    parents = [[]]
+    for depth, (rank, label) in enumerate(zip(ranks, rank_names)):
+        n = n_species if rank == 's' else max(1, min(n_species, 2 * 3 ** depth))
+        level = []
+        for i in range(n):
+            parent = parents[rng.integers(0, len(parents))]
+            tax_id = str(len(names) + 1)
+            names[tax_id] = "{}{}".format(label, i)
+            lineage = parent + [tax_id]
+            taxonpath[tax_id] = {r: (lineage[j] if j < len(lineage) else "")
+                                 for j, r in enumerate(ranks)}
+            level.append(lineage)
+        parents = level
+    species = [[names[x] for x in lineage] for lineage in parents]
+    return names, taxonpath, species
+
+
+def make_counts(rng, n_samples, n_features, density):
+    """Sparse counts, features x samples, at least one read per sample."""
+    from scipy.sparse import csc_matrix
+    indptr = [0]
+    indices = []
+    for _ in range(n_samples):
+        k = max(1, rng.binomial(n_features, density))
+        indices.append(np.sort(rng.choice(n_features, k, replace=False)))
+        indptr.append(indptr[-1] + k)
+    indices = np.concatenate(indices)
+    data = np.ceil(rng.lognormal(2, 1.5, len(indices)))
+    return csc_matrix((data, indices, indptr), shape=(n_features, n_samples))
+
+
+def write_fastq(path, rng, seqs, weights, n_reads, read_length, reverse):
+    picked = rng.choice(len(seqs), n_reads, p=weights)
+    quality = rng.integers(53, 74, (n_reads, read_length), dtype=np.uint8)
+    # fixed mtime keeps the archives identical between runs
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb",
+                                                mtime=0) as f:
+        for i, s in enumerate(picked):
+            seq = seqs[s]
+            if reverse:
+                seq = seq.translate(complement)[::-1]
+            f.write("@read{}\n{}\n+\n{}\n".format(
+                i, seq[:read_length], quality[i].tobytes().decode()).encode())
+
+
+def generate(outdir, samples, features, density, reads=1000, read_length=150,
+             seed=0):
+    """Write a synthetic cohort to ``outdir``.
+
+    Parameters
+    ----------
+    outdir : str
+        Output folder, created if needed.
+    samples, features : int
+        Size of the feature table.
+    density : float
+        Expected fraction of nonzero entries of the table.
+    reads : int
+        Read pairs per sample, 0 to skip the FASTQ files.
+    read_length : int
+        Length of the reads.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    dict
+        Description of the generated data.
+    """
+    import biom
+    from qiime2 import Artifact
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(outdir, exist_ok=True)
+    sample_ids = ["S{:04d}".format(i + 1) for i in range(samples)]
+    feature_ids, seqs = make_sequences(rng, features, max(250, read_length))
+    counts = make_counts(rng, samples, features, density)
+
+    table = biom.Table(counts, feature_ids, sample_ids)
+    with open(os.path.join(outdir, "table.biom"), "w") as f:
+        table.to_json("Snaq benchmarks", direct_io=f)
+    Artifact.import_data("FeatureTable[Frequency]", table).save(
+        os.path.join(outdir, "table.qza"))
+
+    names, taxonpath, species = make_taxonomy(rng, max(1, features // 3))
+    with open(os.path.join(outdir, "names.json"), "w") as f:
+        json.dump(names, f)
+    with open(os.path.join(outdir, "taxonpath.json"), "w") as f:
+        json.dump(taxonpath, f)
+
+    # a part of the features is only classified down to the genus
+    assigned = rng.integers(0, len(species), features)
+    depth = np.where(rng.random(features) < 0.2, 6, 7)
+    taxa = [";".join("{}__{}".format(r, species[a][i] if i < d else "")
+                     for i, r in enumerate(ranks))
+            for a, d in zip(assigned, depth)]
+    taxonomy = pd.DataFrame({'Taxon': [t.replace(";", "; ") for t in taxa],
+                             'Confidence': rng.uniform(0.7, 1, features)},
+                            index=pd.Index(feature_ids, name='Feature ID'))
+    Artifact.import_data("FeatureData[Taxonomy]", taxonomy).save(
+        os.path.join(outdir, "taxonomy.qza"))
+
+    # species level collapse: taxa x features indicator times the counts
+    from scipy.sparse import csr_matrix
+    codes, uniques = pd.factorize(pd.Series(taxa))
+    indicator = csr_matrix((np.ones(features), (codes, np.arange(features))),
+                           shape=(len(uniques), features))
+    otu = biom.Table(indicator.dot(counts), list(uniques), sample_ids)
+    with open(os.path.join(outdir, "otu_tax.biom"), "w") as f:
+        otu.to_json("Snaq benchmarks", direct_io=f)
+
+    fastq = os.path.join(outdir, "fastq")
+    if reads:
+        os.makedirs(fastq, exist_ok=True)
+        for c, sample in enumerate(sample_ids):
+            col = counts.getcol(c)
+            weights = np.zeros(features)
+            weights[col.indices] = col.data
+            weights /= weights.sum()
+            for direction, reverse in (("R1", False), ("R2", True)):
+                write_fastq(os.path.join(
+                    fastq, "{}_{}_001.fastq.gz".format(sample, direction)),
+                    rng, seqs, weights, reads, read_length, reverse)
+
+    ret = {'samples': samples, 'features': features, 'density': density,
+           'nnz': int(counts.nnz), 'taxa': len(uniques),
+           'taxonomy_ids': len(names),
+           'min_depth': int(counts.sum(axis=0).min()),
+           'reads': reads, 'read_length': read_length,
+           'seed': seed}
+    with open(os.path.join(outdir, "dataset.json"), "w") as f:
+        json.dump(ret, f, indent=1)
+    return ret
+
+
+@click.command()
+@click.option("-o", "outdir", required=True, type=str)
+@click.option("-s", "samples", default=100, type=int)
+@click.option("-f", "features", default=2000, type=int)
+@click.option("-d", "density", default=0.05, type=float,
+              help="Expected fraction of nonzero counts.")
+@click.option("-r", "reads", default=1000, type=int,
+              help="Read pairs per sample, 0 to skip the FASTQ files.")
+@click.option("-l", "read_length", default=150, type=int)
+@click.option("--seed", default=0, type=int)
+def main(outdir, samples, features, density, reads, read_length, seed):
+    print(json.dumps(generate(outdir, samples, features, density, reads,
+                              read_length, seed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Benchmark the Python stages of the pipeline on synthetic data.
+
+For every size a cohort is generated with ``generate.py`` and each stage is
+run as the Snakefile runs it, ``python scripts/<stage>.py ...``, in a fresh
+process with an empty artifact cache. The wall time, the largest peak
+resident memory of a single process of the stage (the stage or one of its
+worker processes, not their sum) and the throughput are written to a JSON
+file::
+
+    python benchmarks/run.py -s 100x2000x0.05 -s 1000x10000x0.02 \\
+        -o temp/benchmarks/results.json
+
+Run it in the QIIME2 conda environment. A previous results file can be
+given with ``--baseline`` to report the stages which got slower.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import click
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+# stage -> (script, arguments, unit of the throughput), the arguments are
+# formatted with the data folder {d}, the output folder {o}, {threads} and
+# the rarefaction depth {depth}
+stages = {
+    'create_manifest': ("create_manifest_file.py",
+                        "-i {d}/fastq -o {o}/manifest.tsv", "files"),
+    'make_biom': ("make_biom.py",
+                  "--tablef {d}/table.qza --taxonomy {d}/taxonomy.qza "
+                  "--output {o}/otu_tax.biom", "samples"),
+    'artifact_view': ("artifact_view.py",
+                      "--artifact {d}/table.qza --filename {o}/table.biom "
+                      "--filetype biom", "samples"),
+    'alpha_diversity': ("alpha_diversity.py",
+                        "--inp {d}/table.qza --outp {o}/alpha.tsv "
+                        "--threads {threads}", "samples"),
+    'beta_diversity': ("beta_diversity.py",
+                       "--inp {d}/table.qza --outp {o}/beta.csv "
+                       "--threads {threads}", "samples"),
+    'rarefaction_sweep': ("rarefaction_sweep.py",
+                          "--inp {d}/table.qza --depths {depth} --iterations 10 "
+                          "--curves {o}/curves.tsv --tables {depth} "
+                          "--table-outp {o}/table_{{depth}}.qza "
+                          "--threads {threads}", "samples"),
+    'taxonomy_index': ("build_taxonomy_index.py",
+                       "-t {d}/taxonpath.json -n {d}/names.json "
+                       "-o {d}/taxonomy.sqlite", "taxa"),
+    'manta': ("manta.py",
+              "-i {d}/otu_tax.biom -b {d}/taxonomy.sqlite -d 1 -r {depth} "
+              "-o {o}/manta.csv -x {o}/manta_tax.csv -a {o}/manta_abundant.csv "
+              "-s {o}/manta_samples.csv", "samples"),
+}
+
+
+def parse_size(size):
+    """``samples x features x density``, e.g. ``100x2000x0.05``."""
+    try:
+        samples, features, density = size.split("x")
+        return int(samples), int(features), float(density)
+    except ValueError:
+        raise click.BadParameter("Expected samplesxfeaturesxdensity: " + size)
+
+
+def measure(cmd, env):
+    """Run a command, return its exit code, wall time and largest RSS in MB."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=root, env=env)
+    # ru_maxrss of wait4 is the largest RSS of a single process, the stage or
+    # one of its children, not a total over them
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return proc.returncode, wall, usage.ru_maxrss / scale
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print the runs slower than the baseline, return their number."""
+    def key(r):
+        return (r['stage'], r['samples'], r['features'], r['density'])
+    before = {}
+    for r in baseline['results']:
+        if r['returncode'] == 0:
+            before[key(r)] = min(before.get(key(r), r['wall_s']), r['wall_s'])
+    best = {}
+    for r in results:
+        if r['returncode'] == 0:
+            best[key(r)] = min(best.get(key(r), r['wall_s']), r['wall_s'])
+    slower = 0
+    for k, wall in sorted(best.items()):
+        if k in before and wall > before[k] * (1 + tolerance):
+            slower += 1
+            print("Slower: {} {}x{}x{} {:.2f}s (baseline {:.2f}s)".format(
+                *k, wall, before[k]))
+    return slower
+
+
+@click.command()
+@click.option("-s", "sizes", multiple=True, default=["100x2000x0.05"],
+              help="samplesxfeaturesxdensity, repeat for several sizes.")
+@click.option("--stages", "selected", default=",".join(stages),
+              help="Comma separated stages.")
+@click.option("-r", "reads", default=1000, type=int,
+              help="Read pairs per sample of the FASTQ files.")
+@click.option("-t", "threads", default=1, type=int)
+@click.option("-n", "repeat", default=1, type=int,
+              help="Number of runs of every stage.")
+@click.option("--seed", default=0, type=int)
+@click.option("-w", "workdir", default="temp/benchmarks", type=str)
+@click.option("-o", "output", default="temp/benchmarks/results.json", type=str)
+@click.option("--baseline", default=None, type=str,
+              help="Previous results file to compare with.")
+@click.option("--tolerance", default=0.2, type=float,
+              help="Allowed slowdown relative to the baseline.")
+def benchmark(sizes, selected, reads, threads, repeat, seed, workdir, output,
+              baseline, tolerance):
+    selected = selected.split(",")
+    unknown = [s for s in selected if s not in stages]
+    if unknown:
+        raise click.BadParameter("Unknown stage(s): " + ",".join(unknown))
+    # the index is needed by manta
+    if 'manta' in selected and 'taxonomy_index' not in selected:
+        selected.insert(selected.index('manta'), 'taxonomy_index')
+    workdir = os.path.abspath(workdir)
+    results = []
+
+    for size in sizes:
+        samples, features, density = parse_size(size)
+        data = os.path.join(workdir, "data", "{}x{}x{}-{}".format(
+            samples, features, density, seed))
+        needed = reads if 'create_manifest' in selected else 0
+        dataset = None
+        if os.path.exists(os.path.join(data, "dataset.json")):
+            with open(os.path.join(data, "dataset.json")) as f:
+                dataset = json.load(f)
+        # the data is reused unless FASTQ files are missing or of another size
+        if dataset is None or (needed and dataset['reads'] != needed):
+            # generated in another process, the runner stays small as the
+            # stages are forked from it
+            subprocess.run([sys.executable, os.path.join(here, "generate.py"),
+                            "-o", data, "-s", str(samples), "-f", str(features),
+                            "-d", str(density), "-r", str(needed),
+                            "--seed", str(seed)], check=True)
+            with open(os.path.join(data, "dataset.json")) as f:
+                dataset = json.load(f)
+        units = {'samples': samples, 'taxa': dataset['taxonomy_ids'],
+                 'files': 2 * samples}
+
+        for stage in selected:
+            script, args, unit = stages[stage]
+            for i in range(repeat):
+                out = os.path.join(workdir, "runs", stage)
+                os.makedirs(out, exist_ok=True)
+                env = dict(os.environ,
+                           SNAQ_ARTIFACT_CACHE=os.path.join(out, "cache"),
+                           MPLBACKEND="Agg")
+                shutil.rmtree(env["SNAQ_ARTIFACT_CACHE"], ignore_errors=True)
+                cmd = [sys.executable, os.path.join("scripts", script)] + \
+                    args.format(d=data, o=out, threads=threads,
+                                depth=dataset['min_depth']).split()
+                code, wall, rss = measure(cmd, env)
+                record = {
+                    'stage': stage, 'samples': samples, 'features': features,
+                    'density': density, 'nnz': dataset['nnz'],
+                    'threads': threads, 'run': i, 'returncode': code,
+                    'wall_s': round(wall, 4), 'peak_rss_mb': round(rss, 1),
+                    'throughput': round(units[unit] / wall, 2),
+                    'throughput_unit': unit + "/s",
+                    'nnz_per_s': round(dataset['nnz'] / wall, 1)}
+                results.append(record)
+                print("{stage} {samples}x{features}x{density}: {wall_s:.2f}s "
+                      "{peak_rss_mb:.0f}MB {throughput} {throughput_unit}"
+                      .format(**record))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({'revision': git_revision(),
+                   'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': os.cpu_count(),
+                   'reads': reads, 'seed': seed,
+                   'results': results}, f, indent=1)
+
+    failed = [r for r in results if r['returncode'] != 0]
+    for r in failed:
+        print("Failed: {stage} {samples}x{features}x{density}".format(**r))
+    slower = 0
+    if baseline:
+        with open(baseline) as f:
+            slower = compare(results, json.load(f), tolerance)
+    if failed or slower:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
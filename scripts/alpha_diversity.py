@@ -1,39 +1,176 @@
-"""This script calculates Alpha diversity using QIIME2 functions.
-"""
+"""This script calculates Alpha diversity.
 
+The table is loaded once as a sparse matrix and the metrics listed in
+``engine_metrics`` are computed together, chunk by chunk over the samples.
+Other metrics are delegated to the QIIME2 ``alpha`` pipeline.
+"""
 
+from concurrent.futures import ProcessPoolExecutor
 
 import click
+import biom
+import numpy as np
 from qiime2 import Artifact
 from qiime2 import Metadata
 import pandas as pd
 from qiime2.plugins.diversity.pipelines import alpha
+from artifact_cache import view
+import profiling
+
+# metric -> column name used by the QIIME2 alpha pipeline
+engine_metrics = {
+    'shannon': 'shannon_entropy',
+    'simpson': 'simpson',
+    'dominance': 'dominance',
+    'chao1': 'chao1',
+    'observed_features': 'observed_features',
+    'pielou_e': 'pielou_evenness',
+    'goods_coverage': 'goods_coverage',
+    'berger_parker_d': 'berger_parker_d',
+    'menhinick': 'menhinick',
+    'margalef': 'margalef',
+    'mcintosh_d': 'mcintosh_d',
+}
+
+
+def alpha_chunk(matrix, metrics):
+    """Compute alpha diversity metrics of a block of samples.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        Counts, samples x features.
+    metrics : list of str
+        Metrics, keys of ``engine_metrics``.
+
+    Returns
+    -------
+    dict
+        Metric -> array of one value per sample. The formulas are the ones
+        of ``skbio.diversity.alpha``.
+    """
+    matrix = matrix.tocsr()
+    matrix.eliminate_zeros()
+    n_samples = matrix.shape[0]
+    rows = np.repeat(np.arange(n_samples), np.diff(matrix.indptr))
+
+    def rowsum(x):
+        return np.bincount(rows, weights=x, minlength=n_samples)
+
+    counts = matrix.data
+    n = rowsum(counts)
+    observed = np.diff(matrix.indptr).astype(float)
+    ret = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = counts / n[rows]
+        if {'shannon', 'pielou_e'} & set(metrics):
+            entropy = -rowsum(p * np.log(p))
+        if {'simpson', 'dominance'} & set(metrics):
+            dominance = rowsum(p * p)
+        for metric in metrics:
+            if metric == 'shannon':
+                ret[metric] = entropy / np.log(2)
+            elif metric == 'simpson':
+                ret[metric] = 1 - dominance
+            elif metric == 'dominance':
+                ret[metric] = dominance
+            elif metric == 'chao1':
+                singles = rowsum(counts == 1)
+                doubles = rowsum(counts == 2)
+                ret[metric] = observed + singles * (singles - 1) / (2 * (doubles + 1))
+            elif metric == 'observed_features':
+                ret[metric] = observed.astype(int)
+            elif metric == 'pielou_e':
+                ret[metric] = entropy / np.log(observed)
+            elif metric == 'goods_coverage':
+                ret[metric] = 1 - rowsum(counts == 1) / n
+            elif metric == 'berger_parker_d':
+                ret[metric] = matrix.max(axis=1).toarray().ravel() / n
+            elif metric == 'menhinick':
+                ret[metric] = observed / np.sqrt(n)
+            elif metric == 'margalef':
+                ret[metric] = (observed - 1) / np.log(n)
+            elif metric == 'mcintosh_d':
+                u = np.sqrt(rowsum(counts * counts))
+                ret[metric] = (n - u) / (n - np.sqrt(n))
+    return ret
+
+
+def alpha_engine(table, metrics, threads=1, chunk_size=1000):
+    """Compute several alpha diversity metrics in one pass over a table.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Feature table.
+    metrics : list of str
+        Metrics, keys of ``engine_metrics``.
+    threads : int
+        Number of worker processes.
+    chunk_size : int
+        Number of samples handled by a worker at a time.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One column per metric, indexed by sample id.
+    """
+    matrix = table.matrix_data.T.tocsr()
+    chunks = [matrix[i:i + chunk_size]
+              for i in range(0, matrix.shape[0], chunk_size)]
+    if threads > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            res = list(pool.map(alpha_chunk, chunks, [metrics] * len(chunks)))
+    else:
+        res = [alpha_chunk(chunk, metrics) for chunk in chunks]
+    df = pd.DataFrame({engine_metrics[m]: np.concatenate([r[m] for r in res])
+                       for m in metrics}, index=table.ids())
+    df.index.name = 'Sample ID'
+    return df
+
 
 @click.command()
 @click.option("--inp")
 @click.option("--metrics", default='shannon,simpson,chao1,observed_features')
 @click.option("--outp")
-def alpha_diversity(inp, metrics, outp):
-    """[summary]
+@click.option("--threads", default=1, type=int)
+@click.option("--chunk-size", default=1000, type=int)
+def alpha_diversity(inp, metrics, outp, threads, chunk_size):
+    """Compute alpha diversity metrics of a feature table.
 
     Parameters
     ----------
-    inp : [type]
-        [description]
-    metrics : [type]
-        [description]
-    outp : [type]
-        [description]
+    inp : str
+        FeatureTable[Frequency] artifact.
+    metrics : str
+        Comma separated metrics.
+    outp : str
+        Metadata TSV file with one column per metric.
+    threads : int
+        Number of worker processes.
+    chunk_size : int
+        Number of samples handled by a worker at a time.
     """
-    a = Artifact.load(inp)
     _metrics=metrics.split(",")
-    ret = []
+    native = [m for m in _metrics if m in engine_metrics]
+    ret = {}
 
+    if native:
+        with profiling.stage("load"):
+            table = view(inp, biom.Table)
+        profiling.count(samples=len(table.ids()),
+                        features=len(table.ids(axis='observation')))
+        with profiling.stage("compute"):
+            df = alpha_engine(table, native, threads, chunk_size)
+        ret.update({m: df[[engine_metrics[m]]] for m in native})
     for metric in _metrics:
-        r = alpha(a, metric)
-        ret.append(r.alpha_diversity.view(Metadata).to_dataframe())
+        if metric not in ret:
+            with profiling.stage("qiime2_alpha"):
+                r = alpha(Artifact.load(inp), metric)
+                ret[metric] = r.alpha_diversity.view(Metadata).to_dataframe()
 
-    x = pd.concat(ret, axis=1)
-    Metadata(x).save(outp)
+    x = pd.concat([ret[m] for m in _metrics], axis=1)
+    with profiling.stage("write"):
+        Metadata(x).save(outp)
 if __name__ == "__main__":
     alpha_diversity()
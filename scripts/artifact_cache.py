@@ -0,0 +1,197 @@
+"""Shared cache of extracted QIIME2 artifacts.
+
+Artifacts are extracted once into ``$SNAQ_ARTIFACT_CACHE/<uuid>`` (default
+``temp/artifact_cache``) and reused by every script and export rule, instead
+of unzipping the same ``.qza`` into a fresh temporary directory each time.
+Only ``metadata.yaml`` and ``data/`` are kept. The entries are used read-only.
+
+The cache is bounded by ``$SNAQ_ARTIFACT_CACHE_SIZE`` megabytes (default
+50000); the least recently used entries are evicted first. Concurrent jobs
+are coordinated with ``flock``: an entry is extracted under an exclusive
+lock of its own (``<uuid>.extract.lock``), readers keep a shared lock on
+``<uuid>.lock`` until they exit, and eviction skips the entries that are in
+use. Jobs starting together on the same artifact wait for one extraction,
+then run side by side.
+
+Usage as a script exports the data of an artifact like ``qiime tools export``,
+hard linking the files from the cache::
+
+    python scripts/artifact_cache.py --artifact X.qza --output temp/X
+"""
+
+import fcntl
+import glob
+import os
+import pathlib
+import shutil
+import zipfile
+
+import click
+
+_held = []
+
+
+def cache_dir():
+    return os.environ.get("SNAQ_ARTIFACT_CACHE", "temp/artifact_cache")
+
+
+def cache_size():
+    return int(os.environ.get("SNAQ_ARTIFACT_CACHE_SIZE", "50000")) * 1024 ** 2
+
+
+def _lock(path, mode):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, mode)
+    return fd
+
+
+def _tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def _peek(path):
+    """Return the UUID and the format name of an artifact."""
+    with zipfile.ZipFile(path) as z:
+        uuid = z.namelist()[0].split("/")[0]
+        fmt = None
+        for line in z.read(uuid + "/metadata.yaml").decode().splitlines():
+            if line.startswith("format:"):
+                fmt = line.split(":", 1)[1].strip()
+    return uuid, fmt
+
+
+def _extract(path, uuid, entry):
+    """Extract an artifact as ``entry``, under its extraction lock."""
+    # left by crashed extractions, no other one can be running
+    for leftover in glob.glob(glob.escape(entry) + ".tmp-*"):
+        if os.path.isdir(leftover):
+            shutil.rmtree(leftover)
+        else:
+            os.remove(leftover)
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    tmp = "{}.tmp-{}".format(entry, os.getpid())
+    with zipfile.ZipFile(path) as z:
+        members = [m for m in z.namelist()
+                   if m.startswith(uuid + "/data/") or
+                   m == uuid + "/metadata.yaml"]
+        z.extractall(tmp, members)
+    os.rename(os.path.join(tmp, uuid), entry)
+    os.rmdir(tmp)
+    with open(tmp + ".size", "w") as f:
+        f.write(str(_tree_size(entry)))
+    os.replace(tmp + ".size", entry + ".size")
+
+
+def extract(path):
+    """Extract an artifact into the cache, unless it is there already.
+
+    The caller holds a shared lock on the entry until the process exits.
+
+    Returns
+    -------
+    tuple
+        The ``data`` directory of the entry and the name of its format.
+    """
+    root = cache_dir()
+    os.makedirs(root, exist_ok=True)
+    uuid, fmt = _peek(path)
+    entry = os.path.join(root, uuid)
+    # shared until the process exits, guards the entry against eviction
+    fd = _lock(entry + ".lock", fcntl.LOCK_SH)
+    # the .size file is written last, it marks a complete entry
+    if not os.path.isfile(entry + ".size"):
+        extract_fd = _lock(entry + ".extract.lock", fcntl.LOCK_EX)
+        try:
+            if not os.path.isfile(entry + ".size"):
+                _extract(path, uuid, entry)
+        finally:
+            os.close(extract_fd)
+    os.utime(entry)
+    _held.append(fd)
+    evict(keep=uuid)
+    return os.path.join(entry, "data"), fmt
+
+
+def evict(keep=None):
+    """Remove the least recently used entries above the size bound."""
+    root = cache_dir()
+    try:
+        guard = _lock(os.path.join(root, ".evict.lock"),
+                      fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return
+    try:
+        entries = []
+        for name in os.listdir(root):
+            entry = os.path.join(root, name)
+            if name != keep and os.path.isfile(entry + ".size"):
+                with open(entry + ".size") as f:
+                    entries.append((os.path.getmtime(entry), int(f.read()), entry))
+        total = sum(e[1] for e in entries)
+        for _, size, entry in sorted(entries):
+            if total <= cache_size():
+                break
+            try:
+                fd = _lock(entry + ".lock", fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                os.remove(entry + ".size")
+                shutil.rmtree(entry)
+                total -= size
+            finally:
+                os.close(fd)
+    finally:
+        os.close(guard)
+
+
+def view(artifact, view_type):
+    """View an artifact from the cache.
+
+    Parameters
+    ----------
+    artifact : str or qiime2.Artifact
+        Path of a ``.qza`` file. An already loaded Artifact is viewed directly.
+    view_type : type
+        Any view type registered by the QIIME2 plugins (``biom.Table``,
+        ``qiime2.Metadata``, a directory format...).
+    """
+    if not isinstance(artifact, str):
+        return artifact.view(view_type)
+    from qiime2.sdk import PluginManager
+    from qiime2.core.transform import ModelType
+    data_dir, fmt_name = extract(artifact)
+    record = PluginManager().formats.get(fmt_name)
+    if record is None:
+        from qiime2 import Artifact
+        return Artifact.load(artifact).view(view_type)
+    fmt = getattr(record, "format", record)
+    transformation = ModelType.from_view_type(fmt).make_transformation(
+        ModelType.from_view_type(view_type))
+    return transformation(pathlib.Path(data_dir))
+
+
+def link(src, dst):
+    """Hard link a file of the cache, or copy it across file systems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@click.command()
+@click.option("--artifact", required=True, type=str)
+@click.option("--output", required=True, type=str)
+def export(artifact, output):
+    data_dir, _ = extract(artifact)
+    for root, _, files in os.walk(data_dir):
+        target = os.path.join(output, os.path.relpath(root, data_dir))
+        os.makedirs(target, exist_ok=True)
+        for f in files:
+            link(os.path.join(root, f), os.path.join(target, f))
+
+
+if __name__ == "__main__":
+    export()
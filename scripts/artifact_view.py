@@ -1,44 +1,74 @@
 import click
-from qiime2 import Artifact
 from qiime2 import Metadata
 from skbio import DistanceMatrix
 import pandas as pd
 import biom
-import json        
+from common import write_biom, write_table
+from artifact_cache import view
+import profiling
 
 @click.command()
 @click.option("--artifact")
-@click.option("--filename")
-@click.option("--filetype")
-def export(artifact, filename, filetype):
+@click.option("--filename",
+              help="Output; metadata, distance and table exports are written "
+                   "as Parquet when it ends with .parquet, as TSV otherwise.")
+@click.option("--filetype",
+              type=click.Choice(["metadata", "distance", "biom", "table"]))
+@click.option("--biom-format", default="json",
+              type=click.Choice(["json", "hdf5"]))
+def export(artifact, filename, filetype, biom_format):
 
     if filetype=="metadata":        
-        df = Artifact.load(artifact).view(Metadata).to_dataframe()
-        df.to_csv(filename, sep="\t")
+        with profiling.stage("load"):
+            df = view(artifact, Metadata).to_dataframe()
+        with profiling.stage("write"):
+            write_table(df, filename, sep="\t", dictionary=[
+                c for c in df.columns if df[c].dtype == object])
     
     if filetype=="distance":        
-        df = Artifact.load(artifact).view(DistanceMatrix).to_data_frame()
-        df.to_csv(filename, sep="\t")
+        with profiling.stage("load"):
+            df = view(artifact, DistanceMatrix).to_data_frame()
+        with profiling.stage("write"):
+            write_table(df, filename, sep="\t")
+
+    if filetype=="table":
+        # long form, one row per nonzero count
+        with profiling.stage("load"):
+            if artifact.endswith(".biom"):
+                art = biom.load_table(artifact)
+            else:
+                art = view(artifact, biom.Table)
+        m = art.matrix_data.tocoo()
+        profiling.count(samples=len(art.ids()),
+                        features=len(art.ids(axis='observation')),
+                        nonzero=int(m.nnz))
+        df = pd.DataFrame({
+            'feature-id': pd.Categorical.from_codes(
+                m.row, art.ids(axis='observation')),
+            'sample-id': pd.Categorical.from_codes(m.col, art.ids()),
+            'count': m.data})
+        with profiling.stage("write"):
+            write_table(df, filename, sep="\t", index=False,
+                        dictionary=['feature-id', 'sample-id'])
 
     if filetype=="biom":
         taxonomy_levels = ['kingdum', 'phylum', 'class', 'order', 'family', 'genus', 'species']
-        art = Artifact.load(artifact).view(biom.Table)
-        
-        meta_ = {x['id']: x['id'].split(";") for x in json.loads(art.to_json("QIIME2"))['rows']}
-
-        meta__ = {}
-        
-        for u, h in meta_.items():
-            meta__[u]= {'id': u, 'taxonomy': h}
-        
-        
+        with profiling.stage("load"):
+            art = view(artifact, biom.Table)
+        profiling.count(samples=len(art.ids()),
+                        features=len(art.ids(axis='observation')))
+
+        # plain str, the HDF5 writer does not handle numpy strings
+        meta__ = {u: {'id': str(u), 'taxonomy': str(u).split(";")}
+                  for u in art.ids(axis='observation')}
+
         art.add_metadata(meta__, axis='observation')
         art.type = "OTU table"
         #art.remove_empty()
         #print(art.metadata(axis='observation'))
-        with open(filename, "w") as f:
-            f.write(art.to_json(generated_by="QIIME2"))
+        with profiling.stage("write"):
+            write_biom(art, filename, biom_format)
 
 
 if __name__ == "__main__":
-    export()
\ No newline at end of file
+    export()
@@ -1,21 +1,144 @@
+"""This script calculates non-phylogenetic beta diversity.
+
+The table is loaded once and every metric is computed tile by tile over
+blocks of samples, in parallel, into memory-mapped ``.npy`` matrices. The
+distance matrices can then be rendered block by block to text files in the
+layout of ``DistanceMatrix.to_data_frame().to_csv()``. Metrics missing from
+``engine_metrics`` are delegated to the QIIME2 ``beta`` pipeline.
+"""
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import click
-from qiime2 import Artifact
-from qiime2 import Metadata
-from skbio import DistanceMatrix
+import biom
+import numpy as np
 import pandas as pd
+from qiime2 import Artifact
 from qiime2.plugins.diversity.pipelines import beta
+from skbio import DistanceMatrix
+from artifact_cache import view
+import profiling
+from scipy.spatial.distance import cdist
+
+# metric -> (scipy metric, presence/absence)
+engine_metrics = {
+    'braycurtis': ('braycurtis', False),
+    'jaccard': ('jaccard', True),
+}
+
+_matrix = None
+_outputs = None
+
+
+def _init_worker(matrix, outputs):
+    global _matrix, _outputs
+    _matrix = matrix
+    _outputs = outputs
+
+
+def _block(matrix, start, stop, presence):
+    block = matrix[start:stop].toarray()
+    return block > 0 if presence else block
+
+
+def distance_tile(tile):
+    """Compute one tile of every distance matrix and store it and its mirror."""
+    i0, i1, j0, j1 = tile
+    for metric, path in _outputs.items():
+        name, presence = engine_metrics[metric]
+        d = cdist(_block(_matrix, i0, i1, presence),
+                  _block(_matrix, j0, j1, presence), name)
+        if i0 == j0:
+            np.fill_diagonal(d, 0)
+        mm = np.load(path, mmap_mode="r+")
+        mm[i0:i1, j0:j1] = d
+        mm[j0:j1, i0:i1] = d.T
+        mm.flush()
+        del mm
+
+
+def beta_engine(table, outputs, threads=1, block_size=500):
+    """Compute several distance matrices into memory-mapped files.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Feature table.
+    outputs : dict
+        Metric (key of ``engine_metrics``) -> ``.npy`` file to write.
+    threads : int
+        Number of worker processes.
+    block_size : int
+        Number of samples per side of a tile.
+    """
+    matrix = table.matrix_data.T.tocsr()
+    n = matrix.shape[0]
+    for path in outputs.values():
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float64,
+                                  shape=(n, n)).flush()
+    bounds = [(i, min(i + block_size, n)) for i in range(0, n, block_size)]
+    tiles = [a + b for k, a in enumerate(bounds) for b in bounds[k:]]
+    if threads > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=_init_worker,
+                                 initargs=(matrix, outputs)) as pool:
+            list(pool.map(distance_tile, tiles))
+    else:
+        _init_worker(matrix, outputs)
+        for tile in tiles:
+            distance_tile(tile)
+
+
+def render(path, ids, filename, block_size=500):
+    """Write a ``.npy`` distance matrix as text, one block of rows at a time."""
+    mm = np.load(path, mmap_mode="r")
+    ids = pd.Index(ids)
+    with open(filename, "w") as f:
+        pd.DataFrame(columns=ids).to_csv(f)
+        for i in range(0, len(ids), block_size):
+            pd.DataFrame(mm[i:i + block_size], index=ids[i:i + block_size],
+                         columns=ids).to_csv(f, header=False)
+
 
 @click.command()
 @click.option("--inp")
 @click.option("--metrics", default='braycurtis,jaccard')
-@click.option("--outp")
-def beta_diversity(inp, metrics, outp):
-    a = Artifact.load(inp)
+@click.option("--outp", help="Text output, the metric is appended to the name.")
+@click.option("--matrix-outp",
+              help="Memory-mapped .npy output, the metric is appended to the "
+                   "name. Temporary files are used when omitted.")
+@click.option("--threads", default=1, type=int)
+@click.option("--block-size", default=500, type=int)
+def beta_diversity(inp, metrics, outp, matrix_outp, threads, block_size):
     _metrics=metrics.split(",")
+    native = [m for m in _metrics if m in engine_metrics]
+
+    def with_metric(template, metric):
+        return template.split(".")[0]+"_" + metric + "."+template.split(".")[1]
 
+    if native:
+        with profiling.stage("load"):
+            table = view(inp, biom.Table)
+        profiling.count(samples=len(table.ids()),
+                        features=len(table.ids(axis='observation')))
+        with tempfile.TemporaryDirectory() as tmp:
+            if matrix_outp:
+                outputs = {m: with_metric(matrix_outp, m) for m in native}
+            else:
+                outputs = {m: os.path.join(tmp, m + ".npy") for m in native}
+            with profiling.stage("compute"):
+                beta_engine(table, outputs, threads, block_size)
+            if outp:
+                with profiling.stage("write"):
+                    for metric in native:
+                        render(outputs[metric], table.ids(),
+                               with_metric(outp, metric), block_size)
     for metric in _metrics:
-        r = beta(a, metric)
-        r.distance_matrix.view(DistanceMatrix).to_data_frame().to_csv(outp.split(".")[0]+"_" + 
-            metric + "."+outp.split(".")[1])
+        if metric not in engine_metrics:
+            with profiling.stage("qiime2_beta"):
+                r = beta(Artifact.load(inp), metric)
+                r.distance_matrix.view(DistanceMatrix).to_data_frame().to_csv(
+                    with_metric(outp, metric))
 if __name__ == "__main__":
     beta_diversity()
@@ -0,0 +1,49 @@
+"""Compile db/taxonpath.json and db/names.json into an SQLite index.
+
+``manta.py`` queries the index lazily instead of loading both JSON files on
+every run.
+"""
+
+import json
+import os
+import sqlite3
+import click
+import profiling
+
+ranks = ['k', 'p', 'c', 'o', 'f', 'g', 's']
+
+
+@click.command()
+@click.option("-t", "taxonpath", required=True, type=str)
+@click.option("-n", "names", required=True, type=str)
+@click.option("-o", "output", required=True, type=str)
+def build_taxonomy_index(taxonpath, names, output):
+    tmp = output + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    with open(names) as f:
+        names = json.load(f)
+    profiling.count(names=len(names))
+    con.execute("CREATE TABLE names (id TEXT PRIMARY KEY, name)")
+    con.executemany("INSERT INTO names VALUES (?, ?)", names.items())
+    # names are not unique, the last id wins as in {v: k for k, v in names.items()}
+    con.execute("CREATE TABLE name_ids (name PRIMARY KEY, id)")
+    con.executemany("INSERT INTO name_ids VALUES (?, ?)",
+                    {v: k for k, v in names.items()}.items())
+    del names
+
+    with open(taxonpath) as f:
+        taxonpath = json.load(f)
+    con.execute("CREATE TABLE taxonpath (id TEXT PRIMARY KEY, {})".format(
+        ", ".join(ranks)))
+    con.executemany("INSERT INTO taxonpath VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((k,) + tuple(v[r] for r in ranks)
+                     for k, v in taxonpath.items()))
+    con.commit()
+    con.close()
+    os.replace(tmp, output)
+
+
+if __name__ == "__main__":
+    build_taxonomy_index()
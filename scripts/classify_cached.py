@@ -0,0 +1,112 @@
+"""Assign taxonomy to ASVs reusing previous classifications.
+
+Classifications are kept in an SQLite database keyed by the md5 of the ASV
+sequence, the UUID of the classifier artifact and the classification
+parameters. Only the sequences missing from the database are sent to
+``classify-sklearn``.
+"""
+
+import hashlib
+import sqlite3
+import click
+import pandas as pd
+from qiime2 import Artifact
+from qiime2.sdk import Result
+from artifact_cache import view
+from common import save_artifact
+import profiling
+
+
+def open_cache(cache):
+    con = sqlite3.connect(cache, timeout=600)
+    con.execute("CREATE TABLE IF NOT EXISTS taxonomy ("
+                "seq_hash TEXT, classifier TEXT, confidence TEXT, "
+                "read_orientation TEXT, taxon TEXT, score TEXT, "
+                "PRIMARY KEY (seq_hash, classifier, confidence, read_orientation))")
+    return con
+
+
+def lookup(con, hashes, key):
+    """Return the cached ``(taxon, score)`` of every hash found."""
+    ret = {}
+    hashes = list(hashes)
+    # stay below the SQLite limit on query parameters
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        rows = con.execute(
+            "SELECT seq_hash, taxon, score FROM taxonomy "
+            "WHERE classifier=? AND confidence=? AND read_orientation=? "
+            "AND seq_hash IN ({})".format(",".join("?" * len(chunk))),
+            key + tuple(chunk))
+        ret.update({h: (t, s) for h, t, s in rows})
+    return ret
+
+
+def classify(sequences, classifier, confidence, read_orientation, threads):
+    from qiime2.plugins.feature_classifier.methods import classify_sklearn
+    reads = Artifact.import_data("FeatureData[Sequence]", sequences)
+    res = classify_sklearn(reads=reads,
+                           classifier=Artifact.load(classifier),
+                           confidence=confidence,
+                           read_orientation=read_orientation,
+                           n_jobs=threads)
+    return res.classification.view(pd.DataFrame)
+
+
+@click.command()
+@click.option("--seq", required=True, type=str)
+@click.option("--classifier", required=True, type=str)
+@click.option("--cache", required=True, type=str)
+@click.option("--confidence", default="0.7", type=str)
+@click.option("--read-orientation", default="auto", type=str)
+@click.option("--threads", default=1, type=int)
+@click.option("--output", required=True, type=str)
+def classify_cached(seq, classifier, cache, confidence, read_orientation, threads, output):
+    with profiling.stage("load"):
+        sequences = view(seq, pd.Series)
+    hashes = pd.Series(
+        [hashlib.md5(str(s).encode()).hexdigest() for s in sequences],
+        index=sequences.index)
+    # "disable" is the confidence value understood by classify-sklearn, the
+    # numbers are normalised so that e.g. 0.7 and 0.70 share cache entries
+    if confidence != "disable":
+        try:
+            confidence = float(confidence)
+        except ValueError:
+            raise click.BadParameter("Expected a number or disable: " +
+                                     confidence, param_hint="--confidence")
+    key = (str(Result.peek(classifier).uuid),
+           confidence if confidence == "disable" else repr(confidence),
+           read_orientation)
+
+    con = open_cache(cache)
+    try:
+        found = lookup(con, hashes.unique(), key)
+        missing = ~hashes.isin(found.keys())
+        print("{} of {} sequences found in the cache".format(
+            (~missing).sum(), len(hashes)))
+        profiling.count(features=len(hashes), cached=int((~missing).sum()))
+        if missing.any():
+            todo = sequences[missing][~hashes[missing].duplicated()]
+            with profiling.stage("classify"):
+                res = classify(todo, classifier, confidence, read_orientation,
+                               threads)
+            new = {hashes[f]: (row['Taxon'], str(row['Confidence']))
+                   for f, row in res.iterrows()}
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?, ?, ?)",
+                    [(h,) + key + v for h, v in new.items()])
+            found.update(new)
+    finally:
+        con.close()
+
+    df = pd.DataFrame([found[h] for h in hashes], index=hashes.index,
+                      columns=['Taxon', 'Confidence'])
+    df.index.name = 'Feature ID'
+    with profiling.stage("write"):
+        save_artifact(Artifact.import_data("FeatureData[Taxonomy]", df), output)
+
+
+if __name__ == "__main__":
+    classify_cached()
@@ -0,0 +1,395 @@
+"""Helpers shared by the Snaq helper scripts.
+
+The scripts are executed as ``python scripts/<name>.py`` so this module is
+importable from all of them as ``common``.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import profiling
+
+
+def run_command(cmd, verbose=True):
+    print("Running external command line application. This may print "
+          "messages to stdout and/or stderr.")
+    print("The command being run is below. This command cannot "
+          "be manually re-run as it will depend on temporary files that "
+          "no longer exist.")
+    print("\nCommand:", end=' ')
+    print(" ".join(cmd), end='\n\n')
+    t0 = time.perf_counter()
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        profiling.external(cmd, time.perf_counter() - t0)
+
+
+def plan_threads(threads, n_jobs):
+    """Split a thread budget between concurrent per-sample jobs.
+
+    Parameters
+    ----------
+    threads : int
+        Total number of threads the rule is allowed to use.
+    n_jobs : int
+        Number of per-sample jobs to run.
+
+    Returns
+    -------
+    tuple of int
+        ``(workers, tool_threads)``: the number of jobs to run at the same
+        time and the number of threads to pass to the external tool of each
+        job. ``workers * tool_threads`` never exceeds ``threads``.
+    """
+    threads = max(1, int(threads))
+    workers = max(1, min(threads, n_jobs))
+    return workers, max(1, threads // workers)
+
+
+class SampleFailures(Exception):
+    """Raised when one or more per-sample jobs failed."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        lines = ["{}: {}".format(k, v) for k, v in sorted(failures.items())]
+        super().__init__("{} sample(s) failed:\n{}".format(
+            len(failures), "\n".join(lines)))
+
+
+def run_per_sample(jobs, workers=1):
+    """Run per-sample jobs in a bounded pool.
+
+    Every job is run even if some of them fail; the failures are collected
+    and reported together once all jobs finished.
+
+    Parameters
+    ----------
+    jobs : dict
+        Mapping of sample id to a callable taking no argument.
+    workers : int
+        Maximum number of jobs running at the same time.
+
+    Raises
+    ------
+    SampleFailures
+        If at least one job raised an exception.
+    """
+    failures = {}
+    if workers <= 1:
+        for sample_id, job in jobs.items():
+            try:
+                job()
+            except Exception as e:
+                failures[sample_id] = e
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(job): sample_id
+                       for sample_id, job in jobs.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+    if failures:
+        raise SampleFailures(failures)
+
+
+class SampleStore:
+    """Per-sample results kept between runs.
+
+    Every sample has a folder ``<root>/<sample id>`` holding its files and
+    the key of the inputs they were made from; a sample is only computed
+    again when its key changes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, sample_id, key):
+        """Folder of a sample computed from ``key``, or None."""
+        path = os.path.join(self.root, sample_id)
+        try:
+            with open(os.path.join(path, "key.json")) as f:
+                if json.load(f) == key:
+                    return path
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def put(self, sample_id, key, make):
+        """Call ``make(folder)`` to write the files of a sample and store them."""
+        path = os.path.join(self.root, sample_id)
+        tmp = "{}.tmp-{}".format(path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        make(tmp)
+        with open(os.path.join(tmp, "key.json"), "w") as f:
+            json.dump(key, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        return path
+
+    def prune(self, sample_ids):
+        """Remove the samples which are not in ``sample_ids``."""
+        if not os.path.isdir(self.root):
+            return
+        for name in set(os.listdir(self.root)) - set(sample_ids):
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+
+def _member_keys(path):
+    """Name, CRC and size of the data files of an artifact, by file name."""
+    import zipfile
+    with zipfile.ZipFile(path) as z:
+        return {os.path.basename(i.filename): [i.CRC, i.file_size]
+                for i in z.infolist() if "/data/" in i.filename}
+
+
+def trim_per_sample(artifact, trim_pair, threads=1, store=None):
+    """Apply a paired-end trimming step to every sample of an artifact.
+
+    Parameters
+    ----------
+    artifact : str or qiime2.Artifact
+        ``SampleData[PairedEndSequencesWithQuality]`` artifact, read through
+        the artifact cache when given as a path.
+    trim_pair : callable
+        Called as ``trim_pair(fwd_in, rev_in, fwd_out, rev_out, threads)``
+        for every sample; it must write the two output fastq files.
+    threads : int
+        Total number of threads shared by the per-sample jobs.
+    store : str, optional
+        Folder of a ``SampleStore`` keeping the trimmed reads of every
+        sample; only the samples whose input reads changed since the
+        previous run are trimmed. ``artifact`` must be a path.
+
+    Returns
+    -------
+    qiime2.Artifact
+        Artifact holding the trimmed reads with the original manifest.
+    """
+    from functools import partial
+    import pandas as pd
+    from qiime2 import Artifact
+    from artifact_cache import view, link
+    from q2_types.per_sample_sequences import (
+        SingleLanePerSamplePairedEndFastqDirFmt,
+        FastqManifestFormat,
+        YamlFormat)
+    with profiling.stage("load"):
+        art_ = view(artifact, SingleLanePerSamplePairedEndFastqDirFmt)
+    manifest_o = pd.read_csv(os.path.join(
+        str(art_), art_.manifest.pathspec), header=0, comment='#',
+        dtype={'sample-id': str})
+    manifest = manifest_o.copy()
+    manifest.filename = manifest.filename.apply(
+        lambda x: os.path.join(str(art_), x))
+    id_to_fps = manifest.pivot(
+        index='sample-id', columns='direction', values='filename')
+    result = SingleLanePerSamplePairedEndFastqDirFmt()
+
+    todo = id_to_fps
+    if store:
+        store = SampleStore(store)
+        members = _member_keys(artifact)
+        keys = {sample_id: [members[os.path.basename(fwd_fp)],
+                            members[os.path.basename(rev_fp)]]
+                for sample_id, (fwd_fp, rev_fp) in id_to_fps.iterrows()}
+        todo = id_to_fps[[store.get(i, keys[i]) is None
+                          for i in id_to_fps.index]]
+        store.prune(id_to_fps.index)
+        print("{} of {} samples to trim".format(len(todo), len(id_to_fps)))
+    workers, tool_threads = plan_threads(threads, max(1, len(todo)))
+    profiling.count(samples=len(id_to_fps), trimmed=len(todo))
+
+    def stored(sample_id, fwd_fp, rev_fp, p1, p2):
+        # stored under fixed names, the file names of a sample can change
+        # between imports
+        names = ("R1.fastq.gz", "R2.fastq.gz")
+        path = store.get(sample_id, keys[sample_id])
+        if path is None:
+            path = store.put(sample_id, keys[sample_id], lambda d: trim_pair(
+                fwd_fp, rev_fp, os.path.join(d, names[0]),
+                os.path.join(d, names[1]), tool_threads))
+        link(os.path.join(path, names[0]), p1)
+        link(os.path.join(path, names[1]), p2)
+
+    jobs = {}
+    for sample_id, (fwd_fp, rev_fp) in id_to_fps.iterrows():
+        p1 = str(os.path.join(result.path, os.path.split(fwd_fp)[1]))
+        p2 = str(os.path.join(result.path, os.path.split(rev_fp)[1]))
+        if store:
+            jobs[sample_id] = partial(stored, sample_id, fwd_fp, rev_fp, p1, p2)
+        else:
+            jobs[sample_id] = partial(trim_pair, fwd_fp, rev_fp, p1, p2,
+                                      tool_threads)
+    with profiling.stage("compute"):
+        run_per_sample(jobs, workers)
+
+    with profiling.stage("write"):
+        result.manifest.write_data(art_.manifest.view(
+            FastqManifestFormat), FastqManifestFormat)
+        result.metadata.write_data(art_.metadata.view(YamlFormat), YamlFormat)
+        return Artifact.import_data('SampleData[PairedEndSequencesWithQuality]',
+                                    result)
+
+
+class Archive:
+    """Zip archive written member by member.
+
+    Files are copied in chunks, nothing is staged on disk. The archive is
+    written to a temporary name and moved into place once closed without
+    error.
+
+    Parameters
+    ----------
+    path : str
+        Zip file to write.
+    level : int
+        Deflate compression level, 0 (fastest) to 9 (smallest).
+    """
+
+    def __init__(self, path, level=6):
+        import zipfile
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.zip = zipfile.ZipFile(self.tmp, "w", zipfile.ZIP_DEFLATED,
+                                   compresslevel=level)
+
+    def add(self, path, name=None):
+        """Copy a file as the member ``name``, its base name by default."""
+        self.zip.write(path, name or os.path.basename(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.zip.close()
+        if exc_type is None:
+            os.replace(self.tmp, self.path)
+        else:
+            os.remove(self.tmp)
+
+
+def save_artifact(artifact, filename, compression=None):
+    """Save a QIIME2 artifact with the compression of the pipeline.
+
+    Parameters
+    ----------
+    artifact : qiime2.Artifact
+        Artifact to save.
+    filename : str
+        ``.qza`` file.
+    compression : str, optional
+        ``default`` saves with ``Artifact.save`` (every member deflated).
+        ``fast`` stores the members which are already gzipped, the fastq
+        files, as they are and deflates the others at level 1. ``none``
+        stores every member. Taken from ``$SNAQ_QZA_COMPRESSION`` when not
+        given.
+    """
+    import zipfile
+    compression = compression or os.environ.get("SNAQ_QZA_COMPRESSION",
+                                                "default")
+    if compression == "default":
+        artifact.save(filename)
+        return
+    if compression not in ("fast", "none"):
+        raise ValueError("Unknown artifact compression: " + compression)
+    # the layout written by Artifact.save: <uuid>/... without hidden files
+    source = str(artifact._archiver.path)
+    tmp = filename + ".tmp"
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                         compresslevel=1) as zf:
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                stored = compression == "none" or name.endswith(".gz")
+                zf.write(path, os.path.relpath(path, source).replace(os.sep, "/"),
+                         compress_type=zipfile.ZIP_STORED if stored
+                         else zipfile.ZIP_DEFLATED)
+    os.replace(tmp, filename)
+
+
+def write_table(df, filename, sep=",", index=True, dictionary=(),
+                row_group_size=1 << 20):
+    """Write a DataFrame as text, or as Parquet for ``.parquet`` file names.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table to write.
+    filename : str
+        Output file; the format is chosen by its extension.
+    sep : str
+        Field separator of the text format.
+    index : bool
+        Whether the index is written, as the first column(s).
+    dictionary : list of str
+        Columns dictionary-encoded by the Parquet writer, for columns with
+        few distinct values repeated on many rows; all columns by default.
+    row_group_size : int
+        Number of rows converted and written at a time in Parquet.
+    """
+    if not filename.endswith(".parquet"):
+        df.to_csv(filename, sep=sep, index=index)
+        return
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow, listed in the QIIME2 "
+                          "environment files, or use a text output")
+    if index:
+        df = df.reset_index()
+    df.columns = [str(c) for c in df.columns]
+    writer = None
+    try:
+        for start in range(0, max(len(df), 1), row_group_size):
+            chunk = df.iloc[start:start + row_group_size]
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(
+                    filename, table.schema,
+                    use_dictionary=list(dictionary) if dictionary else True)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema,
+                                             preserve_index=False)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_biom(table, filename, biom_format="json", generated_by="QIIME2"):
+    """Write a BIOM table without building it as a string in memory.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Table to write.
+    filename : str
+        Output file.
+    biom_format : str
+        ``"json"`` (BIOM 1.0) or ``"hdf5"`` (BIOM 2.1).
+    generated_by : str
+        Value of the ``generated-by`` field.
+    """
+    if biom_format == "hdf5":
+        from biom.util import biom_open
+        with biom_open(filename, "w") as f:
+            table.to_hdf5(f, generated_by)
+    elif biom_format == "json":
+        with open(filename, "w") as f:
+            table.to_json(generated_by, direct_io=f)
+    else:
+        raise ValueError("Unknown BIOM format: " + biom_format)
@@ -2,6 +2,7 @@ import pandas as pd
 import click
 import os
 from os.path import join, abspath
+import profiling
 
 
 
@@ -10,10 +11,15 @@ identifiers = [{'R1':"_1", 'R2':"_2"},
                {'R1':"_R1_", "R2": "_R2_"}]
 
 
-@click.command()
-@click.option("-i", "input_folder", required=True, type=str)
-@click.option("-o", "manifest_file_name", required=True, type=str)
-def create_manifest(input_folder, manifest_file_name):
+def find_pairs(input_folder):
+    """Pair the R1 and R2 fastq files of a folder.
+
+    Returns
+    -------
+    dict
+        Columns of the manifest: ``sample-id``,
+        ``forward-absolute-filepath`` and ``reverse-absolute-filepath``.
+    """
     files = [join(input_folder, x) for x in os.listdir(input_folder)]
     for iden in identifiers:
         # step 1
@@ -32,13 +38,40 @@ def create_manifest(input_folder, manifest_file_name):
             break
     
     condition3 = all([_r[0].replace(R1_id, "_")==_r[1].replace(R2_id, '_') for _r in zip(R1, R2)])
-    if all([condition2, condition3]):
-        R1 = [abspath(x) for x in R1]
-        R2 = [abspath(x) for x in R2]
-        res = {"sample-id": sample_id1,
-               "forward-absolute-filepath": R1,
-               "reverse-absolute-filepath": R2}
-    pd.DataFrame(res).to_csv(manifest_file_name, sep="\t", index=False)
+    if not all([condition2, condition3]):
+        raise click.ClickException(
+            "The R1 and R2 files of {} cannot be paired".format(input_folder))
+    R1 = [abspath(x) for x in R1]
+    R2 = [abspath(x) for x in R2]
+    return {"sample-id": sample_id1,
+            "forward-absolute-filepath": R1,
+            "reverse-absolute-filepath": R2}
+
+
+@click.command()
+@click.option("-i", "input_folder", required=True, type=str)
+@click.option("-o", "manifest_file_name", required=True, type=str)
+@click.option("-x", "index", default=None, type=str,
+              help="Index written by scan_fastq.py.")
+@click.option("--bad-samples", default="exclude",
+              type=click.Choice(["exclude", "keep", "fail"]),
+              help="What to do with the samples the index reports as bad.")
+def create_manifest(input_folder, manifest_file_name, index, bad_samples):
+    res = pd.DataFrame(find_pairs(input_folder))
+    if index:
+        stats = pd.read_csv(index, sep="\t", index_col="sample-id",
+                            dtype={'sample-id': str}, keep_default_na=False)
+        status = res["sample-id"].map(stats["status"]).fillna("not scanned")
+        bad = status != "ok"
+        for sample_id, s in zip(res["sample-id"][bad], status[bad]):
+            message = stats["message"].get(sample_id, "")
+            print("Bad sample {}: {} {}".format(sample_id, s, message))
+        if bad.any() and bad_samples == "fail":
+            raise click.ClickException("{} bad sample(s)".format(bad.sum()))
+        if bad_samples == "exclude":
+            res = res[~bad]
+    profiling.count(samples=len(res))
+    res.to_csv(manifest_file_name, sep="\t", index=False)
 
 if __name__ == "__main__":
     create_manifest()
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""Denoise one batch of the samples of an artifact with DADA2.
+
+The samples of a ``SampleData[PairedEndSequencesWithQuality]`` artifact are
+split into ``--shards`` batches of similar size (in bytes of fastq). The
+batch ``--shard`` is assembled from hard links to the artifact cache, so the
+raw data is neither moved nor recompressed, and denoised with the options of
+the ``dada2`` rule. The batches are merged back with ``merge_cohorts.py``.
+
+The error model and the chimera consensus of DADA2 are computed per batch,
+the results can thus differ slightly from a single run over the cohort.
+"""
+
+import os
+import shutil
+
+import click
+import pandas as pd
+from qiime2 import Artifact
+
+import profiling
+from artifact_cache import extract, link
+from common import save_artifact
+
+
+def shard_samples(sizes, shard, shards):
+    """Samples of a batch.
+
+    Parameters
+    ----------
+    sizes : pandas.Series
+        Size in bytes of the reads of each sample, indexed by sample id.
+    shard : int
+        Batch to return, from 0 to ``shards - 1``.
+    shards : int
+        Number of batches.
+
+    Returns
+    -------
+    list of str
+        Sample ids; the largest samples are placed first, each in the
+        lightest batch, so the batches are balanced and always the same
+        for the same artifact.
+    """
+    loads = [0] * shards
+    ret = [[] for _ in range(shards)]
+    order = sorted(sizes.items(), key=lambda x: (-x[1], x[0]))
+    for sample_id, size in order:
+        i = loads.index(min(loads))
+        loads[i] += size
+        ret[i].append(sample_id)
+    return sorted(ret[shard])
+
+
+def shard_artifact(artifact, shard, shards):
+    """Artifact made of the samples of one batch."""
+    from q2_types.per_sample_sequences import \
+        SingleLanePerSamplePairedEndFastqDirFmt
+    data_dir, _ = extract(artifact)
+    manifest = pd.read_csv(os.path.join(data_dir, "MANIFEST"), header=0,
+                           comment='#', dtype={'sample-id': str})
+    sizes = manifest.groupby('sample-id')['filename'].agg(
+        lambda x: sum(os.path.getsize(os.path.join(data_dir, f)) for f in x))
+    if shards > len(sizes):
+        raise click.ClickException(
+            "{} shards for {} samples, use fewer shards".format(
+                shards, len(sizes)))
+    samples = shard_samples(sizes, shard, shards)
+    profiling.count(samples=len(samples), cohort_samples=len(sizes))
+
+    result = SingleLanePerSamplePairedEndFastqDirFmt()
+    manifest = manifest[manifest['sample-id'].isin(samples)]
+    for f in manifest['filename']:
+        link(os.path.join(data_dir, f), os.path.join(str(result.path), f))
+    manifest.to_csv(os.path.join(str(result.path), "MANIFEST"), index=False)
+    shutil.copyfile(os.path.join(data_dir, "metadata.yml"),
+                    os.path.join(str(result.path), "metadata.yml"))
+    return Artifact.import_data('SampleData[PairedEndSequencesWithQuality]',
+                                result)
+
+
+@click.command()
+@click.option("-i", "inp", required=True, type=str)
+@click.option("--shard", required=True, type=int)
+@click.option("--shards", required=True, type=int)
+@click.option("--table", required=True, type=str)
+@click.option("--repseq", required=True, type=str)
+@click.option("--stats", required=True, type=str)
+@click.option("--threads", default=1, type=int)
+def dada2_shard(inp, shard, shards, table, repseq, stats, threads):
+    if not 0 <= shard < shards:
+        raise click.BadParameter("--shard must be between 0 and --shards - 1")
+    from qiime2.plugins.dada2.methods import denoise_paired
+    with profiling.stage("load"):
+        seqs = shard_artifact(inp, shard, shards)
+    with profiling.stage("denoise"):
+        res = denoise_paired(demultiplexed_seqs=seqs, trunc_len_f=0,
+                             trunc_len_r=0, n_threads=threads)
+    with profiling.stage("write"):
+        save_artifact(res.table, table)
+        save_artifact(res.representative_sequences, repseq)
+        save_artifact(res.denoising_stats, stats)
+
+
+if __name__ == "__main__":
+    dada2_shard()
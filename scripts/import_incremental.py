@@ -0,0 +1,108 @@
+"""Import the fastq files of a manifest, reusing the previous import.
+
+Same result as ``qiime tools import --type
+'SampleData[PairedEndSequencesWithQuality]' --input-format
+PairedEndFastqManifestPhred33V2``. Every sample imported is kept in a
+``SampleStore`` (see ``common.py``) keyed by the path, size and modification
+time of its two fastq files; when samples are added to a cohort only the new
+or changed ones are imported, the others are hard linked from the store.
+Samples removed from the manifest are removed from the store.
+
+The trimming scripts keep the same kind of store with ``--store``, so the
+trimmed artifacts are rebuilt from the new samples too. Writing the final
+``.qza`` still reads every sample once.
+"""
+
+import os
+import tempfile
+
+import click
+import pandas as pd
+from qiime2 import Artifact
+
+import profiling
+from artifact_cache import link
+from common import SampleStore, run_per_sample, save_artifact
+
+
+def sample_key(row):
+    """Paths, sizes and modification times of the fastq files of a sample."""
+    key = []
+    for column in ("forward-absolute-filepath", "reverse-absolute-filepath"):
+        st = os.stat(row[column])
+        key.append([row[column], st.st_size, st.st_mtime_ns])
+    return key
+
+
+def import_sample(row, folder):
+    """Import the reads of one sample, write their files in ``folder``."""
+    from q2_types.per_sample_sequences import \
+        SingleLanePerSamplePairedEndFastqDirFmt
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = os.path.join(tmp, "MANIFEST.tsv")
+        pd.DataFrame([row]).to_csv(manifest, sep="\t", index=False)
+        art = Artifact.import_data('SampleData[PairedEndSequencesWithQuality]',
+                                   manifest, 'PairedEndFastqManifestPhred33V2')
+        fmt = art.view(SingleLanePerSamplePairedEndFastqDirFmt)
+        rows = pd.read_csv(os.path.join(str(fmt), "MANIFEST"), header=0,
+                           comment='#')
+        for f in rows['filename']:
+            link(os.path.join(str(fmt), f), os.path.join(folder, f))
+        rows.to_csv(os.path.join(folder, "MANIFEST"), index=False)
+
+
+def assemble(manifest, store):
+    """Artifact made of the stored samples, in the order of the manifest."""
+    from q2_types.per_sample_sequences import \
+        SingleLanePerSamplePairedEndFastqDirFmt
+    result = SingleLanePerSamplePairedEndFastqDirFmt()
+    rows = []
+    for sample_id in manifest['sample-id']:
+        folder = os.path.join(store.root, sample_id)
+        sample = pd.read_csv(os.path.join(folder, "MANIFEST"), header=0,
+                             dtype={'sample-id': str})
+        for f in sample['filename']:
+            link(os.path.join(folder, f), os.path.join(str(result.path), f))
+        rows.append(sample)
+    pd.concat(rows).to_csv(os.path.join(str(result.path), "MANIFEST"),
+                           index=False)
+    with open(os.path.join(str(result.path), "metadata.yml"), "w") as f:
+        f.write("{phred-offset: 33}\n")
+    # every sample was fully validated when it was imported
+    return Artifact.import_data('SampleData[PairedEndSequencesWithQuality]',
+                                result, validate_level='min')
+
+
+@click.command()
+@click.option("-i", "manifest_file", required=True, type=str,
+              help="Manifest written by create_manifest_file.py.")
+@click.option("-o", "output", required=True, type=str)
+@click.option("--store", required=True, type=str,
+              help="Folder keeping the imported reads of every sample.")
+@click.option("-t", "threads", default=1, type=int)
+def import_incremental(manifest_file, output, store, threads):
+    manifest = pd.read_csv(manifest_file, sep="\t", dtype={'sample-id': str})
+    if manifest['sample-id'].duplicated().any():
+        raise click.ClickException("Duplicated sample ids in " + manifest_file)
+    store = SampleStore(store)
+    keys = {row['sample-id']: sample_key(row) for _, row in manifest.iterrows()}
+    todo = manifest[[store.get(i, keys[i]) is None
+                     for i in manifest['sample-id']]]
+    store.prune(manifest['sample-id'])
+    print("{} of {} samples to import".format(len(todo), len(manifest)))
+    profiling.count(samples=len(manifest), imported=len(todo))
+
+    jobs = {}
+    for _, row in todo.iterrows():
+        def job(row=row):
+            store.put(row['sample-id'], keys[row['sample-id']],
+                      lambda folder: import_sample(row, folder))
+        jobs[row['sample-id']] = job
+    with profiling.stage("compute"):
+        run_per_sample(jobs, threads)
+    with profiling.stage("write"):
+        save_artifact(assemble(manifest, store), output)
+
+
+if __name__ == "__main__":
+    import_incremental()
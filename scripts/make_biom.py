@@ -1,25 +1,31 @@
 import click
 import pandas as pd
 import biom
-import qiime2
-from qiime2 import Artifact
+from artifact_cache import view
+from common import write_biom
+import profiling
 
 @click.command()
 @click.option("--tablef")
 @click.option("--taxonomy")
 @click.option("--output")
-def create_biom_table(tablef, taxonomy, output):
+@click.option("--biom-format", default="json",
+              type=click.Choice(["json", "hdf5"]))
+def create_biom_table(tablef, taxonomy, output, biom_format):
 
     message="QIIME2"
-    biom_table = Artifact.load(tablef).view(biom.Table)
+    with profiling.stage("load"):
+        biom_table = view(tablef, biom.Table)
+        md = view(taxonomy, pd.DataFrame)
+    profiling.count(samples=len(biom_table.ids()),
+                    features=len(biom_table.ids(axis='observation')))
     biom_table.type = "OTU table"
-    md = Artifact.load(taxonomy).view(pd.DataFrame)
     md.index.name = '#OTU ID'
     md.columns = ['taxonomy', 'confidence']
     biom_table.add_metadata(md.to_dict("index"), axis="observation")
-    
-    with open(output, "w") as f:
-        f.write(biom_table.to_json(message))
+
+    with profiling.stage("write"):
+        write_biom(biom_table, output, biom_format, message)
 
 if __name__ == "__main__":
     create_biom_table()
\ No newline at end of file
@@ -1,97 +1,220 @@
+import numpy as np
 import pandas as pd
 import json
+import sqlite3
 import click
+import profiling
+from common import write_table
+
+ranks = ['k', 'p', 'c', 'o', 'f', 'g', 's']
+
+rank_columns = ['kingdom_id', 'phylum_id', 'class_id', 'order_id',
+                'family_id', 'genus_id', 'species_id']
 
 empty_rank = {
     'k': '', 'p':'', 'c':'', 'o':'', 'f':'','g':'','s':''
 }
 
-def get_rank_from_ncbi(rank, taxonomy, taxonpath):
-    ret = [[taxonomy.get(x[3:]) for x in y] for y in rank]
-    ret1 = []
-    for x in ret:
-        if x == [None, None, None, None, None, None, None]:
-            next
-        else:
-            max_id = x[max([i for i in range(len(x)) if x[i] is not None])]
-            txp = taxonpath.get(max_id, empty_rank)
-            item = []
-
-
-            for r in ['k', 'p', 'c', 'o', 'f', 'g', 's']:
-                _item = txp[r]
-                if _item == "":
-                    _item = "uc"
-                item.append(_item)
-            ret1.append(item)
-    return ret1
-
-def top_taxons(df):
-    ret = df.sort_values(9, ascending=False)
-    ret['cumsum'] = ret[9].cumsum()
-    ret = ret[ret['cumsum'] < 90]
-    #print(ret)
-    ret.drop(['cumsum', 8,9,10], axis="columns", inplace=True)
-    ret = ret.melt(id_vars=[0, 11])
-    ret.drop_duplicates(inplace=True)
-    ret.columns = ['sample_id', 'method_id','rank_id', 'taxonomy_id']
-    ret = ret[ret['taxonomy_id']!= 'uc']
-    return ret[['sample_id', 'rank_id', 'taxonomy_id', 'method_id']]
+class Lookup:
+    """Read-only mapping backed by a query on the taxonomy index.
+
+    Only the ``get`` method of a dict is provided; results are memoised.
+    """
+
+    def __init__(self, con, query, convert=lambda row: row[0]):
+        self.con = con
+        self.query = query
+        self.convert = convert
+        self.cache = {}
+
+    def get(self, key, default=None):
+        if key not in self.cache:
+            row = self.con.execute(self.query, (key,)).fetchone()
+            self.cache[key] = None if row is None else self.convert(row)
+        ret = self.cache[key]
+        return default if ret is None else ret
+
+def open_index(index):
+    """Open the index written by build_taxonomy_index.py.
+
+    Returns
+    -------
+    tuple of Lookup
+        name -> id, id -> lineage (a dict of rank ids) and id -> name.
+    """
+    con = sqlite3.connect("file:{}?mode=ro".format(index), uri=True)
+    taxonomy = Lookup(con, "SELECT id FROM name_ids WHERE name=?")
+    taxonpath = Lookup(con, "SELECT {} FROM taxonpath WHERE id=?".format(
+        ", ".join(ranks)), lambda row: dict(zip(ranks, row)))
+    names = Lookup(con, "SELECT name FROM names WHERE id=?")
+    return taxonomy, taxonpath, names
+
+def load_table(input_file):
+    """Load a feature table as a sparse matrix.
+
+    Parameters
+    ----------
+    input_file : str
+        BIOM table (``.biom``), or the TSV written by ``biom convert --to-tsv``.
+
+    Returns
+    -------
+    tuple
+        Observation ids, sample ids and a ``scipy.sparse.csr_matrix`` of
+        observations x samples.
+    """
+    if input_file.endswith(".biom"):
+        import biom
+        table = biom.load_table(input_file)
+        return (np.asarray(table.ids(axis='observation'), dtype=object),
+                np.asarray(table.ids(), dtype=object),
+                table.matrix_data.tocsr())
+    from scipy.sparse import csr_matrix
+    df = pd.read_csv(input_file, sep="\t", skiprows=[0], index_col=0)
+    return (np.asarray(df.index, dtype=object),
+            np.asarray(df.columns, dtype=object),
+            csr_matrix(df.values))
+
+def get_lineages(observation_ids, taxonomy, taxonpath):
+    """Resolve the lineage of every observation.
+
+    Every distinct taxonomy string is resolved once: the deepest rank whose
+    name is found in ``taxonomy`` gives the lineage from ``taxonpath``.
+
+    Returns
+    -------
+    lineages : numpy.ndarray
+        observations x 7 array of taxonomy ids, ``'uc'`` for unclassified
+        ranks.
+    resolved : numpy.ndarray
+        False for the observations without any known rank name.
+    """
+    codes, uniques = pd.factorize(observation_ids)
+    lineages = np.full((len(uniques), len(ranks)), 'uc', dtype=object)
+    resolved = np.zeros(len(uniques), dtype=bool)
+    for i, obs in enumerate(uniques):
+        found = [taxonomy.get(x[3:]) for x in obs.split(";")]
+        found = [x for x in found if x is not None]
+        if not found:
+            continue
+        txp = taxonpath.get(found[-1], empty_rank)
+        lineages[i] = ["uc" if txp[r] == "" else txp[r] for r in ranks]
+        resolved[i] = True
+    return lineages[codes], resolved[codes]
+
+def top_taxons(samples, lineages, rows, cols, indptr, pct):
+    """Ranks of the taxa making up the first 90% of the reads of each sample.
+
+    The nonzero entries are given in CSC order (``rows``, ``cols``,
+    ``indptr``). Samples are reported sorted by id, and within a sample rank
+    by rank in decreasing order of abundance.
+    """
+    kept = []
+    for c in sorted(np.flatnonzero(np.diff(indptr)), key=lambda c: samples[c]):
+        idx = np.arange(indptr[c], indptr[c + 1])
+        # same ordering as DataFrame.sort_values(ascending=False), ties
+        # included, so that the output does not depend on the implementation
+        idx = idx[::-1][pct[idx][::-1].argsort(kind="quicksort")][::-1]
+        kept.append(idx[np.cumsum(pct[idx]) < 90])
+    sizes = [len(x) for x in kept]
+    kept = np.concatenate(kept) if kept else np.zeros(0, dtype=int)
+    group = np.repeat(np.arange(len(sizes)), sizes)
+
+    # melt to one row per (sample, rank, taxon), ordered by sample then rank
+    order = np.argsort(np.tile(group, len(ranks)), kind="stable")
+    ret = pd.DataFrame({
+        'sample_id': np.tile(samples[cols[kept]], len(ranks))[order],
+        'rank_id': np.repeat(np.arange(1, len(ranks) + 1), len(kept))[order],
+        'taxonomy_id': lineages[rows[kept]].T.ravel()[order],
+        'method_id': 1})
+    ret = ret.drop_duplicates()
+    return ret[ret['taxonomy_id'] != 'uc']
 
 @click.command()
 @click.option("-i", "input_file", required=True, type=str)
 #@click.option("-v", "alphadiversity", required=True, type=str)
 @click.option("-o", "output_file", required=True, type=str)
-@click.option("-t", "taxonpath", required=True, type=str)
+@click.option("-t", "taxonpath", type=str)
 @click.option("-s", "sample_file_name", required=True, type=str)
 @click.option("-a", "abundant_taxonomy", required=True, type=str)
-@click.option("-n", "names", required=True, type=str)
+@click.option("-n", "names", type=str)
+@click.option("-b", "index", type=str,
+              help="Taxonomy index built by build_taxonomy_index.py, "
+                   "used instead of -t and -n.")
 @click.option("-d", "database", required=True, type=str)
 @click.option("-r", "rarefaction", required=True, type=int)
 @click.option("-x", "output_taxonomy", required=True, type=str)
 #@click.option("-p", "output_alphadiversity", required=True, type=str)
-def manta(input_file, output_file, taxonpath, abundant_taxonomy, sample_file_name, names, database, rarefaction, output_taxonomy):
-    df = pd.read_csv(input_file, sep="\t", skiprows=[0])
-    with open(taxonpath) as f:
-        taxonpath=json.load(f)
-    with open(names) as f:
-        names=json.load(f)
-    taxonomy = {v:k for k, v in names.items()}
-    taxs = [x.split(";") for x in df['#OTU ID']]
-    d = pd.DataFrame(get_rank_from_ncbi(taxs, taxonomy, taxonpath))
-    d.columns = ['0', '1', '2', '3', '4', '5', '6']
-    df.drop("#OTU ID", axis="columns", inplace=True)
-    df3 = d.join(df)
-
-    df3m = df3.melt(id_vars=['0', '1', '2', '3', '4', '5', '6'])
-    df4 = df3m.loc[:,['0', '1', '2', '3', '4', '5', '6']].copy().melt()
-
-    df3m = df3m.loc[:,['variable', '0', '1', '2', '3', '4', '5', '6', 'value']]
-
-    df3m['pct'] = (df3m['value']/rarefaction)*100
-
-    df3m['db'] = int(database)
-    df3m['method_id'] = 1
-    df3m = df3m[df3m['value']!= 0]
-    df3m.rename(columns={
-        '0' : "kingdom_id", '1': 'phylum_id', '2':'class_id', '3':'order_id', '4':'family_id','5':'genus_id', '6':'species_id','value':'read_num', 'variable':'sample_id', 'pct':'read_pct', 'db':'reference_db_id'}, inplace=True)
-    df3m['read_num'] = df3m['read_num'].astype(int)
-    df3m.to_csv(output_file, index=None)
-
-    df3m['sample_id'].rename("id").drop_duplicates().to_csv(sample_file_name, index=False)
-
-    df4['variable'] = df4['variable'].astype(int) + 1
-    df4 = df4[df4['value']!= "uc"]
-    df4['names'] = [names.get(x) for x in df4['value']]
-    df4=df4.iloc[:,[1,0,2]].drop_duplicates()
-    df4.columns = ['id', "rank_id", "name"]
-    df4.to_csv(output_taxonomy, index=None)
+def manta(input_file, output_file, taxonpath, abundant_taxonomy, sample_file_name, names, index, database, rarefaction, output_taxonomy):
+    paths = {'microbiota.csv': output_file, 'taxonomy.csv': output_taxonomy,
+             'dominant_taxon.csv': abundant_taxonomy,
+             'sample.csv': sample_file_name}
+
+    def output(table, df, dictionary=()):
+        """Write one of the tables, as Parquet if its file is .parquet."""
+        write_table(df, paths[table], index=False, dictionary=dictionary)
+
+    write_tables(input_file, taxonpath, names, index, database, rarefaction,
+                 output)
+
+
+def write_tables(input_file, taxonpath, names, index, database, rarefaction,
+                 output):
+    """Compute the MANTA tables, each is written by ``output(table, df)``."""
+    with profiling.stage("load"):
+        observations, samples, table = load_table(input_file)
+        if index:
+            taxonomy, taxonpath, names = open_index(index)
+        elif taxonpath and names:
+            with open(taxonpath) as f:
+                taxonpath=json.load(f)
+            with open(names) as f:
+                names=json.load(f)
+            taxonomy = {v:k for k, v in names.items()}
+        else:
+            raise click.UsageError("Either -b or both -t and -n are required")
+    profiling.count(samples=len(samples), features=len(observations),
+                    nonzero=int(table.nnz))
+    with profiling.stage("lineages"):
+        lineages, resolved = get_lineages(observations, taxonomy, taxonpath)
+    lineages = lineages[resolved]
+    table = table[np.flatnonzero(resolved)].tocsc()
+    table.eliminate_zeros()
+    table.sort_indices()
+
+    # one row per nonzero entry, sample by sample
+    rows = table.indices
+    cols = np.repeat(np.arange(table.shape[1]), np.diff(table.indptr))
+    pct = (table.data/rarefaction)*100
+    df = pd.DataFrame({'sample_id': samples[cols]})
+    for i, col in enumerate(rank_columns):
+        df[col] = lineages[rows, i]
+    df['read_num'] = table.data.astype(int)
+    df['read_pct'] = pct
+    df['reference_db_id'] = int(database)
+    df['method_id'] = 1
+    with profiling.stage("write"):
+        output('microbiota.csv', df, dictionary=['sample_id'] + rank_columns)
+        output('sample.csv', pd.DataFrame(
+            {'id': samples[np.flatnonzero(np.diff(table.indptr))]}))
+
+    tax = pd.DataFrame({
+        'id': lineages.T.ravel(),
+        'rank_id': np.repeat(np.arange(1, len(ranks) + 1), len(lineages))})
+    if not len(samples):
+        tax = tax.iloc[:0]
+    tax = tax[tax['id'] != "uc"].drop_duplicates()
+    tax['name'] = [names.get(x) for x in tax['id']]
+    with profiling.stage("write"):
+        output('taxonomy.csv', tax)
 
     # abundant_taxons
-    df5 = df3m.copy()
-    df5.columns = range(12)
-    abundant_taxons = pd.DataFrame(df5.groupby(0).apply(lambda x: top_taxons(x))).reset_index(drop=True)
-    abundant_taxons.to_csv(abundant_taxonomy, index=False)
+    with profiling.stage("abundant"):
+        abundant_taxons = top_taxons(samples, lineages, rows, cols,
+                                     table.indptr, pct)
+    with profiling.stage("write"):
+        output('dominant_taxon.csv', abundant_taxons,
+               dictionary=['sample_id', 'taxonomy_id'])
 
     # alpha diversity for manta:
     #alphadiversity_df = pd.read_csv(alphadiversity,comment="#")
@@ -0,0 +1,143 @@
+"""Merge the artifacts of any number of cohorts in a single pass.
+
+Same results as chaining ``qiime feature-table merge``, ``merge-seqs`` and
+``merge-taxa`` over pairs of cohorts, without writing the intermediate
+artifacts:
+
+- tables: the sparse matrices are concatenated sample-wise over the union of
+  the features; a sample present in two cohorts is an error,
+- sequences and taxonomies: the first cohort listing a feature wins,
+- DADA2 stats: the rows of the cohorts are concatenated.
+
+The same merge joins the batches of a sharded DADA2 run (``dada2_shard.py``).
+"""
+
+import os
+import tempfile
+
+import biom
+import click
+import numpy as np
+import pandas as pd
+from qiime2 import Artifact, Metadata
+from scipy.sparse import coo_matrix
+
+import profiling
+from artifact_cache import extract, view
+from common import save_artifact
+
+
+def merge_tables(tables):
+    """Concatenate ``biom.Table`` objects sample-wise.
+
+    Parameters
+    ----------
+    tables : list of biom.Table
+        Tables with disjoint sample ids.
+
+    Returns
+    -------
+    biom.Table
+        Table over the union of the features, in order of first appearance.
+    """
+    features = {}
+    samples = []
+    rows, cols, data = [], [], []
+    for table in tables:
+        fids = table.ids(axis='observation')
+        index = np.array([features.setdefault(f, len(features)) for f in fids],
+                         dtype=np.int64)
+        m = table.matrix_data.tocoo()
+        rows.append(index[m.row])
+        cols.append(m.col + len(samples))
+        data.append(m.data)
+        samples.extend(table.ids())
+    duplicated = pd.Index(samples)[pd.Index(samples).duplicated()]
+    if len(duplicated):
+        raise click.ClickException("Samples present in more than one cohort: "
+                                   + ", ".join(map(str, duplicated.unique())))
+    matrix = coo_matrix((np.concatenate(data),
+                         (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(len(features), len(samples))).tocsr()
+    return biom.Table(matrix, list(features), samples)
+
+
+def fasta_records(path):
+    """Yield ``(id, record text)`` of a FASTA file."""
+    with open(path) as f:
+        header, lines = None, []
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(lines)
+                header, lines = line[1:].split()[0], [line]
+            else:
+                lines.append(line)
+        if header is not None:
+            yield header, "".join(lines)
+
+
+def merge_sequences(paths, output):
+    """Write the sequences of several FASTA files, first occurrence wins."""
+    seen = set()
+    with open(output, "w") as out:
+        for path in paths:
+            for feature, record in fasta_records(path):
+                if feature not in seen:
+                    seen.add(feature)
+                    out.write(record)
+    return len(seen)
+
+
+@click.command()
+@click.option("--kind", required=True,
+              type=click.Choice(["table", "seq", "taxonomy", "stats"]))
+@click.option("--output", required=True)
+@click.argument("inputs", nargs=-1, required=True)
+def merge_cohorts(kind, output, inputs):
+    if kind == "table":
+        with profiling.stage("load"):
+            tables = [view(path, biom.Table) for path in inputs]
+        with profiling.stage("compute"):
+            merged = merge_tables(tables)
+        profiling.count(samples=len(merged.ids()),
+                        features=len(merged.ids(axis='observation')))
+        with profiling.stage("write"):
+            save_artifact(Artifact.import_data("FeatureTable[Frequency]", merged),
+                          output)
+
+    elif kind == "seq":
+        with profiling.stage("load"):
+            fastas = [os.path.join(extract(path)[0], "dna-sequences.fasta")
+                      for path in inputs]
+        with tempfile.TemporaryDirectory() as tmp:
+            merged = os.path.join(tmp, "dna-sequences.fasta")
+            with profiling.stage("compute"):
+                profiling.count(features=merge_sequences(fastas, merged))
+            with profiling.stage("write"):
+                save_artifact(Artifact.import_data("FeatureData[Sequence]", merged),
+                              output)
+
+    elif kind == "stats":
+        with profiling.stage("load"):
+            stats = [view(path, Metadata).to_dataframe() for path in inputs]
+        merged = pd.concat(stats)
+        if merged.index.duplicated().any():
+            raise click.ClickException("Samples present in more than one input")
+        with profiling.stage("write"):
+            save_artifact(Artifact.import_data("SampleData[DADA2Stats]",
+                                               Metadata(merged)), output)
+
+    else:
+        with profiling.stage("load"):
+            taxonomies = [view(path, pd.DataFrame) for path in inputs]
+        merged = pd.concat(taxonomies)
+        merged = merged[~merged.index.duplicated()]
+        profiling.count(features=len(merged))
+        with profiling.stage("write"):
+            save_artifact(Artifact.import_data("FeatureData[Taxonomy]", merged),
+                          output)
+
+
+if __name__ == "__main__":
+    merge_cohorts()
@@ -0,0 +1,41 @@
+"""Pack result files into a zip archive.
+
+Replaces ``zip -j``: the files are stored under their base name and copied
+into the archive in chunks, with the compression level given by ``--level``.
+``-m MEMBER PATH`` stores a file under another name.
+The archive is written to a temporary name and moved into place when done.
+"""
+
+import os
+
+import click
+
+import profiling
+from common import Archive
+
+
+@click.command()
+@click.option("-o", "output", required=True, type=str)
+@click.option("--level", default=6, type=click.IntRange(0, 9),
+              help="Compression level, 0 (fastest) to 9 (smallest).")
+@click.option("-m", "renamed", multiple=True, nargs=2, type=str,
+              metavar="MEMBER PATH", help="Add PATH as MEMBER.")
+@click.argument("inputs", nargs=-1)
+def package_summary(output, level, renamed, inputs):
+    files = list(renamed) + [(os.path.basename(path), path) for path in inputs]
+    if not files:
+        raise click.UsageError("No file to pack")
+    names = [name for name, _ in files]
+    duplicated = {n for n in names if names.count(n) > 1}
+    if duplicated:
+        raise click.ClickException("Several inputs named " +
+                                   ", ".join(sorted(duplicated)))
+    profiling.count(files=len(files))
+    with profiling.stage("write"):
+        with Archive(output, level) as archive:
+            for name, path in files:
+                archive.add(path, name)
+
+
+if __name__ == "__main__":
+    package_summary()
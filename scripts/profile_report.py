@@ -0,0 +1,234 @@
+"""Timing report of the rules run for a cohort.
+
+The jobs are read from the Snakemake metadata (``.snakemake/metadata``) of
+the files under ``results/{cohort}/``: rule, start and end times and inputs.
+The records written by the scripts when ``$SNAQ_PROFILE`` is set (see
+``profiling.py``) add the time of each stage, the peak memory, the counts
+and the time of the external tools. Without Snakemake metadata the report
+is made of the script records only.
+
+The report lists the most expensive rules and the critical path, the chain
+of dependent jobs which took the longest.
+"""
+
+import json
+import os
+import time
+from base64 import urlsafe_b64decode
+
+import click
+import pandas as pd
+
+
+def read_metadata(metadata, prefix):
+    """Jobs which wrote files starting with ``prefix``."""
+    jobs = {}
+    for root, _, files in os.walk(metadata):
+        for name in files:
+            rel = os.path.relpath(os.path.join(root, name), metadata)
+            # long names are split into folders prefixed with @
+            encoded = "".join(x.lstrip("@") for x in rel.split(os.sep))
+            try:
+                output = urlsafe_b64decode(encoded).decode()
+            except (ValueError, UnicodeDecodeError):
+                continue
+            if not output.startswith(prefix):
+                continue
+            with open(os.path.join(root, name)) as f:
+                rec = json.load(f)
+            if rec.get('incomplete') or rec.get('starttime') is None \
+                    or rec.get('endtime') is None:
+                continue
+            job = jobs.setdefault((rec['rule'], rec['starttime']), {
+                'rule': rec['rule'], 'start': rec['starttime'],
+                'end': rec['endtime'], 'inputs': rec.get('input', []),
+                'outputs': []})
+            job['end'] = max(job['end'], rec['endtime'])
+            job['outputs'].append(output)
+    return list(jobs.values())
+
+
+def read_records(records):
+    """Records written by ``profiling.py``, paths made absolute."""
+    ret = []
+    if not records or not os.path.isdir(records):
+        return ret
+    for name in sorted(os.listdir(records)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(records, name)) as f:
+            rec = json.load(f)
+        for key in ('inputs', 'outputs'):
+            rec[key] = {os.path.abspath(os.path.join(rec['cwd'], p)): v
+                        for p, v in rec[key].items()}
+        ret.append(rec)
+    return ret
+
+
+def attach_records(jobs, records, prefix):
+    """Add the script records to their jobs, or make jobs of them."""
+    by_output = {}
+    for job in jobs:
+        job['records'] = []
+        for output in job['outputs']:
+            by_output[os.path.abspath(output)] = job
+    prefix = os.path.abspath(prefix)
+    for rec in records:
+        matched = [by_output[p] for p in rec['outputs'] if p in by_output]
+        if matched:
+            matched[0]['records'].append(rec)
+        elif any(p.startswith(prefix) for p in rec['outputs']):
+            jobs.append({
+                'rule': rec['script'], 'start': rec['start'], 'end': rec['end'],
+                'inputs': list(rec['inputs']),
+                'outputs': [os.path.relpath(p) for p in rec['outputs']],
+                'records': [rec]})
+    return jobs
+
+
+def critical_path(jobs):
+    """Chain of dependent jobs with the largest total wall time."""
+    producer = {}
+    for i, job in enumerate(jobs):
+        for output in job['outputs']:
+            producer[os.path.abspath(output)] = i
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i]['end'])
+    finish = {}
+    previous = {}
+    for i in order:
+        preds = {producer[p] for p in map(os.path.abspath, jobs[i]['inputs'])
+                 if p in producer and producer[p] != i}
+        preds = [p for p in preds if p in finish]
+        best = max(preds, key=lambda p: finish[p], default=None)
+        previous[i] = best
+        finish[i] = jobs[i]['wall'] + (finish[best] if best is not None else 0)
+    if not finish:
+        return []
+    i = max(finish, key=finish.get)
+    path = []
+    while i is not None:
+        path.append(i)
+        i = previous[i]
+    return path[::-1]
+
+
+def hms(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+def job_table(jobs, path):
+    rows = []
+    for i, job in enumerate(jobs):
+        stages = {}
+        external = {}
+        counts = {}
+        rss = None
+        for rec in job['records']:
+            for k, v in rec['stages'].items():
+                stages[k] = stages.get(k, 0) + v
+            for e in rec['external']:
+                external[e['tool']] = external.get(e['tool'], 0) + e['seconds']
+            counts.update(rec['counts'])
+            rss = max(rss or 0, round(rec['peak_rss_mb'], 1))
+        rows.append({
+            'rule': job['rule'],
+            'output': ",".join(sorted(job['outputs'])),
+            'start': time.strftime("%Y-%m-%d %H:%M:%S",
+                                   time.localtime(job['start'])),
+            'wall_s': round(job['wall'], 2),
+            'critical_path': i in path,
+            'peak_rss_mb': rss,
+            'input_mb': round(sum(v['size'] for rec in job['records']
+                                  for v in rec['inputs'].values()) / 2**20, 2)
+            if job['records'] else None,
+            'stages': ";".join("{}={:.2f}".format(k, v)
+                               for k, v in stages.items()),
+            'external': ";".join("{}={:.2f}".format(k, v)
+                                 for k, v in external.items()),
+            'counts': ";".join("{}={}".format(k, v) for k, v in counts.items()),
+        })
+    return pd.DataFrame(rows, columns=[
+        'rule', 'output', 'start', 'wall_s', 'critical_path', 'peak_rss_mb',
+        'input_mb', 'stages', 'external', 'counts'])
+
+
+def write_pdf(outp, cohort, df, path, jobs):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import (Paragraph, SimpleDocTemplate, Spacer,
+                                    Table, TableStyle)
+    styles = getSampleStyleSheet()
+    style = TableStyle([
+        ('FONTSIZE', (0, 0), (-1, -1), 7),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey)])
+
+    def table(frame):
+        return Table([list(frame.columns)] +
+                     frame.astype(str).values.tolist(), style=style,
+                     repeatRows=1)
+
+    story = [Paragraph("Cohort {}: profile".format(cohort), styles['Title'])]
+    if len(df):
+        span = max(j['end'] for j in jobs) - min(j['start'] for j in jobs)
+        story.append(Paragraph(
+            "{} jobs, {} from the first start to the last end, {} of "
+            "cumulated job time, critical path of {}.".format(
+                len(df), hms(span), hms(df['wall_s'].sum()),
+                hms(df.loc[df['critical_path'], 'wall_s'].sum())),
+            styles['Normal']))
+
+    by_rule = df.groupby('rule')['wall_s'].agg(['count', 'sum', 'max'])
+    by_rule = by_rule.sort_values('sum', ascending=False).head(20)
+    by_rule = by_rule.reset_index().rename(columns={
+        'count': 'jobs', 'sum': 'total', 'max': 'longest'})
+    by_rule['total'] = by_rule['total'].map(hms)
+    by_rule['longest'] = by_rule['longest'].map(hms)
+    story += [Spacer(1, 12), Paragraph("Most expensive rules", styles['Heading2']),
+              table(by_rule)]
+
+    crit = df.iloc[path][['rule', 'output', 'wall_s']].copy()
+    crit['output'] = crit['output'].map(os.path.basename)
+    crit['wall_s'] = crit['wall_s'].map(hms)
+    story += [Spacer(1, 12), Paragraph("Critical path", styles['Heading2']),
+              table(crit.rename(columns={'wall_s': 'wall'}))]
+
+    stages = df[df['stages'] != ""].sort_values('wall_s', ascending=False)
+    stages = stages[['rule', 'wall_s', 'peak_rss_mb', 'stages', 'external',
+                     'counts']].head(30)
+    if len(stages):
+        story += [Spacer(1, 12),
+                  Paragraph("Stages of the scripts (seconds)", styles['Heading2']),
+                  table(stages)]
+    SimpleDocTemplate(outp, pagesize=letter, rightMargin=36, leftMargin=36,
+                      topMargin=36, bottomMargin=18).build(story)
+
+
+@click.command()
+@click.option("--cohort", required=True)
+@click.option("--records", default=None,
+              help="Folder of the script records ($SNAQ_PROFILE).")
+@click.option("--metadata", default=".snakemake/metadata")
+@click.option("--table", "table_file", required=True, help="TSV, one row per job.")
+@click.option("--outp", required=True, help="PDF report.")
+def profile_report(cohort, records, metadata, table_file, outp):
+    prefix = os.path.join("results", cohort, "")
+    jobs = read_metadata(metadata, prefix) if os.path.isdir(metadata) else []
+    jobs = attach_records(jobs, read_records(records), prefix)
+    # the report itself is not part of the profile
+    jobs = [j for j in jobs if not any(
+        o in (table_file, outp) for o in j['outputs'])]
+    jobs.sort(key=lambda j: j['start'])
+    for job in jobs:
+        job['wall'] = job['end'] - job['start']
+    path = critical_path(jobs)
+    df = job_table(jobs, path)
+    df.to_csv(table_file, sep="\t", index=False)
+    write_pdf(outp, cohort, df, path, jobs)
+
+
+if __name__ == "__main__":
+    profile_report()
@@ -0,0 +1,119 @@
+"""Optional performance records of the helper scripts.
+
+When ``$SNAQ_PROFILE`` names a folder, every script importing this module
+writes a JSON record there when it exits, with:
+
+- the script, its arguments and start/end times,
+- the time spent in each ``stage`` (e.g. load, compute, write),
+- the peak resident memory of the script and of its child processes,
+- the size of the files given as arguments, before and after the run,
+- ``count`` values such as the number of samples and features,
+- the wall time of the external tools started by ``common.run_command``.
+
+Without ``$SNAQ_PROFILE`` the functions only cost a dictionary update. The
+records are aggregated by ``profile_report.py``.
+"""
+
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+directory = os.environ.get("SNAQ_PROFILE")
+
+_record = {'stages': {}, 'counts': {}, 'external': []}
+_written = False
+
+
+def _paths(argv):
+    """Arguments, and parts of ``--opt=a,b`` arguments, naming a path."""
+    ret = []
+    for arg in argv:
+        for part in arg.split("=")[-1].split(","):
+            if part and os.path.exists(part):
+                ret.append(part)
+    return ret
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f))
+                   for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def _files(paths):
+    ret = {}
+    for path in paths:
+        try:
+            ret[path] = {'size': _size(path), 'mtime': os.path.getmtime(path)}
+        except OSError:
+            pass
+    return ret
+
+
+def start():
+    """Start the record of the current script, called at import time."""
+    global _written
+    _written = False
+    _record.update(
+        script=os.path.basename(sys.argv[0]), argv=sys.argv[1:],
+        cwd=os.getcwd(), pid=os.getpid(), start=time.time(),
+        inputs=_files(_paths(sys.argv[1:])),
+        stages={}, counts={}, external=[])
+
+
+@contextmanager
+def stage(name):
+    """Add the time spent in the ``with`` block to the stage ``name``."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record['stages'][name] = (_record['stages'].get(name, 0)
+                                   + time.perf_counter() - t0)
+
+
+def count(**counts):
+    """Store counts describing the data, e.g. ``count(samples=10)``."""
+    _record['counts'].update(counts)
+
+
+def external(cmd, seconds):
+    """Store the wall time of an external command."""
+    _record['external'].append({'tool': os.path.basename(cmd[0]),
+                                'seconds': seconds})
+
+
+def write_record():
+    """Write the record to ``$SNAQ_PROFILE``, once."""
+    global _written
+    if not directory or _written:
+        return
+    _written = True
+    rec = dict(_record)
+    rec['end'] = time.time()
+    rec['wall'] = rec['end'] - rec['start']
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    rec['peak_rss_mb'] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+    after = _files(_paths(rec['argv']))
+    rec['outputs'] = {p: v for p, v in after.items()
+                      if p not in rec['inputs'] or
+                      v['mtime'] > rec['inputs'][p]['mtime']}
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.join(directory, "{}-{:.6f}-{}.json".format(
+        rec['script'].replace(".py", ""), rec['start'], rec['pid']))
+    with open(name + ".tmp", "w") as f:
+        json.dump(rec, f)
+    os.replace(name + ".tmp", name)
+
+
+if directory:
+    start()
+    atexit.register(write_record)
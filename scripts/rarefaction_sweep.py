@@ -0,0 +1,205 @@
+"""Rarefy a feature table at several depths in one pass.
+
+The table is loaded once. Every sample with at least ``depth`` reads is
+subsampled without replacement (multivariate hypergeometric draw over its
+nonzero features) at every depth and iteration. Each drawn table is reduced
+on the fly to the alpha diversity metrics of ``alpha_diversity.py``, which
+gives the alpha-rarefaction curves. The first iteration at the depths given
+with ``--tables`` is written as a ``FeatureTable[Frequency]`` artifact, like
+``qiime feature-table rarefy``: samples below the depth are dropped and so
+are the features left without reads.
+
+The work is split into blocks of ``--chunk-size`` samples over ``--threads``
+processes. Every block, depth and iteration draws from its own generator,
+seeded from ``--seed`` and these three numbers. The results therefore depend
+on the seed and the chunk size, not on the number of processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import biom
+import click
+import numpy as np
+import pandas as pd
+from qiime2 import Artifact
+
+import profiling
+from alpha_diversity import alpha_chunk, engine_metrics
+from artifact_cache import view
+from common import save_artifact
+from scipy.sparse import csr_matrix, vstack
+
+_matrix = None
+
+
+def _init_worker(matrix):
+    global _matrix
+    _matrix = matrix
+
+
+def subsample(matrix, depth, rng):
+    """Draw ``depth`` reads without replacement from every row of a block.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        Counts, samples x features.
+    depth : int
+        Number of reads to keep per sample.
+    rng : numpy.random.Generator
+        Source of randomness.
+
+    Returns
+    -------
+    tuple
+        ``(rows, rarefied)``: the indices of the samples with at least
+        ``depth`` reads and their subsampled counts, with the sparsity
+        pattern of ``matrix``.
+    """
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    rows = np.flatnonzero(totals >= depth)
+    data = []
+    for i in rows:
+        colors = matrix.data[matrix.indptr[i]:matrix.indptr[i + 1]]
+        data.append(rng.multivariate_hypergeometric(
+            colors.astype(np.int64), depth, method="marginals"))
+    sub = matrix[rows]
+    sub = csr_matrix((np.concatenate(data) if data else sub.data,
+                      sub.indices, sub.indptr), shape=sub.shape)
+    sub.eliminate_zeros()
+    return rows, sub
+
+
+def sweep_chunk(task):
+    """Rarefy one block of samples at every depth and iteration."""
+    start, stop, depths, iterations, metrics, tables, seed = task
+    matrix = _matrix[start:stop]
+    curves = []
+    rarefied = {}
+    for depth in depths:
+        for iteration in range(iterations):
+            rng = np.random.default_rng([seed, depth, iteration, start])
+            rows, sub = subsample(matrix, depth, rng)
+            if iteration == 0 and depth in tables:
+                rarefied[depth] = (rows + start, sub)
+            if not len(rows):
+                continue
+            values = alpha_chunk(sub, metrics)
+            curves.append(pd.DataFrame(dict(
+                {'sample': rows + start, 'depth': depth,
+                 'iteration': iteration},
+                **{engine_metrics[m]: values[m] for m in metrics})))
+    return curves, rarefied
+
+
+def sweep(table, depths, iterations, metrics, tables=(), seed=0, threads=1,
+          chunk_size=1000):
+    """Rarefaction curves and rarefied tables of a table.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Feature table.
+    depths : list of int
+        Depths of the curves.
+    iterations : int
+        Number of draws per depth.
+    metrics : list of str
+        Metrics, keys of ``alpha_diversity.engine_metrics``.
+    tables : list of int
+        Depths at which the rarefied table is returned.
+    seed : int
+        Seed of the generators.
+    threads : int
+        Number of worker processes.
+    chunk_size : int
+        Number of samples handled by a worker at a time.
+
+    Returns
+    -------
+    tuple
+        ``(curves, rarefied)``: a long-form DataFrame with one row per
+        sample, depth and iteration, and a dict of depth -> ``biom.Table``.
+    """
+    matrix = table.matrix_data.T.tocsr()
+    depths = sorted(set(depths) | set(tables))
+    tasks = [(i, min(i + chunk_size, matrix.shape[0]), depths, iterations,
+              metrics, set(tables), seed)
+             for i in range(0, matrix.shape[0], chunk_size)]
+    if threads > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=_init_worker,
+                                 initargs=(matrix,)) as pool:
+            res = list(pool.map(sweep_chunk, tasks))
+    else:
+        _init_worker(matrix)
+        res = [sweep_chunk(task) for task in tasks]
+
+    sample_ids = np.asarray(table.ids())
+    feature_ids = np.asarray(table.ids(axis='observation'))
+    columns = ['sample-id', 'depth', 'iteration'] + \
+        [engine_metrics[m] for m in metrics]
+    frames = [df for curves, _ in res for df in curves]
+    curves = pd.concat(frames) if frames else pd.DataFrame(
+        columns=['sample'] + columns[1:])
+    curves.insert(0, 'sample-id', sample_ids[curves.pop('sample').astype(int)])
+    curves = curves.sort_values(['depth', 'iteration'], kind="stable")
+
+    rarefied = {}
+    for depth in tables:
+        parts = [r[depth] for _, r in res]
+        rows = np.concatenate([p[0] for p in parts])
+        matrix = vstack([p[1] for p in parts]).tocsc()
+        keep = np.flatnonzero(np.diff(matrix.indptr))
+        rarefied[depth] = biom.Table(matrix[:, keep].T.tocsr(),
+                                     feature_ids[keep], sample_ids[rows])
+    return curves[columns].reset_index(drop=True), rarefied
+
+
+def int_list(ctx, param, value):
+    try:
+        return [int(x) for x in value.split(",") if x] if value else []
+    except ValueError:
+        raise click.BadParameter("Comma separated integers expected")
+
+
+@click.command()
+@click.option("--inp", required=True, help="FeatureTable[Frequency] artifact.")
+@click.option("--depths", required=True, callback=int_list,
+              help="Comma separated depths of the curves.")
+@click.option("--iterations", default=10, type=click.IntRange(1))
+@click.option("--metrics", default='observed_features,shannon')
+@click.option("--seed", default=0, type=int)
+@click.option("--curves", "curves_outp", required=True,
+              help="Long-form TSV: sample-id, depth, iteration and metrics.")
+@click.option("--tables", default="", callback=int_list,
+              help="Comma separated depths at which the table is written.")
+@click.option("--table-outp", default=None,
+              help="Name of the rarefied tables, with {depth}.")
+@click.option("--threads", default=1, type=int)
+@click.option("--chunk-size", default=1000, type=int)
+def rarefaction_sweep(inp, depths, iterations, metrics, seed, curves_outp,
+                      tables, table_outp, threads, chunk_size):
+    _metrics = metrics.split(",")
+    unknown = [m for m in _metrics if m not in engine_metrics]
+    if unknown:
+        raise click.BadParameter("Unsupported metric(s): " + ",".join(unknown))
+    if tables and not table_outp:
+        raise click.BadParameter("--tables needs --table-outp")
+    with profiling.stage("load"):
+        table = view(inp, biom.Table)
+    profiling.count(samples=len(table.ids()),
+                    features=len(table.ids(axis='observation')),
+                    depths=len(set(depths) | set(tables)),
+                    iterations=iterations)
+    with profiling.stage("compute"):
+        curves, rarefied = sweep(table, depths, iterations, _metrics, tables,
+                                 seed, threads, chunk_size)
+    with profiling.stage("write"):
+        curves.to_csv(curves_outp, sep="\t", index=False)
+        for depth, t in rarefied.items():
+            save_artifact(Artifact.import_data("FeatureTable[Frequency]", t),
+                          table_outp.format(depth=depth))
+
+
+if __name__ == "__main__":
+    rarefaction_sweep()
@@ -0,0 +1,205 @@
+"""Read quality profile of a ``SampleData[PairedEndSequencesWithQuality]``.
+
+The gzipped fastq members are streamed from the ``.qza`` zip itself, nothing
+is extracted. Every file is read in parallel worker processes and reduced to
+two NumPy histograms: quality score by position in the read, and read
+length. They give:
+
+- ``--summary``: one row per sample and direction with the number of reads,
+  the read lengths, the mean quality and the percentage of bases >= Q30,
+- ``--positions``: quality percentiles (10, 25, 50, 75, 90) and mean by
+  position, over all the samples, for R1 and R2,
+- ``--plot``: the per-position percentiles and the length distribution.
+
+Cheap enough to compare the trimming variants (``+fp-...``, ``+bb-...``) of a
+cohort before choosing the DADA2 parameters.
+"""
+
+import gzip
+import io
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# phred scores counted, higher scores are counted as the highest one
+n_scores = 64
+percentiles = [10, 25, 50, 75, 90]
+
+
+def fastq_members(path):
+    """Sample id, direction and zip member of every fastq file."""
+    with zipfile.ZipFile(path) as z:
+        uuid = z.namelist()[0].split("/")[0]
+        with z.open(uuid + "/data/MANIFEST") as f:
+            manifest = pd.read_csv(f, header=0, comment='#',
+                                   dtype={'sample-id': str})
+    return [(row['sample-id'], row['direction'],
+             "{}/data/{}".format(uuid, row['filename']))
+            for _, row in manifest.iterrows()]
+
+
+def quality_batches(stream, chunk_size=1 << 22):
+    """Yield lists of the quality lines of a fastq stream."""
+    carry = []
+    rest = b""
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        lines = carry + lines
+        end = len(lines) // 4 * 4
+        carry = lines[end:]
+        yield [q.rstrip(b"\r") for q in lines[3:end:4]]
+    lines = carry + ([rest] if rest else [])
+    if len(lines) >= 4:
+        yield [q.rstrip(b"\r") for q in lines[3:len(lines) // 4 * 4:4]]
+
+
+def histograms(batches):
+    """Quality by position (positions x scores) and length histograms."""
+    quality = np.zeros((0, n_scores), dtype=np.int64)
+    lengths = np.zeros(0, dtype=np.int64)
+    for quals in batches:
+        if not quals:
+            continue
+        lens = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+        scores = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64)
+        scores = np.clip(scores - 33, 0, n_scores - 1)
+        pos = np.arange(len(scores)) - np.repeat(np.cumsum(lens) - lens, lens)
+        size = max(len(quality), int(lens.max()))
+        counts = np.bincount(pos * n_scores + scores,
+                             minlength=size * n_scores)
+        quality = np.pad(quality, ((0, size - len(quality)), (0, 0)))
+        quality += counts.reshape(size, n_scores)
+        counts = np.bincount(lens)
+        lengths = np.pad(lengths, (0, max(0, len(counts) - len(lengths))))
+        lengths[:len(counts)] += counts
+    return quality, lengths
+
+
+def profile_member(task):
+    """Histograms of one fastq member of an artifact."""
+    path, sample_id, direction, member = task
+    with zipfile.ZipFile(path) as z, z.open(member) as raw:
+        with gzip.GzipFile(fileobj=io.BufferedReader(raw, 1 << 20)) as f:
+            quality, lengths = histograms(quality_batches(f))
+    return sample_id, direction, quality, lengths
+
+
+def summarize(quality, lengths):
+    """Columns of the summary of one file."""
+    reads = int(lengths.sum())
+    bases = int(quality.sum())
+    per_score = quality.sum(axis=0)
+    observed = np.flatnonzero(lengths)
+    return {
+        'reads': reads,
+        'min_length': int(observed[0]) if reads else 0,
+        'mean_length': round(float((lengths * np.arange(len(lengths))).sum())
+                             / reads, 2) if reads else 0,
+        'max_length': int(observed[-1]) if reads else 0,
+        'mean_quality': round(float((per_score * np.arange(n_scores)).sum())
+                              / bases, 2) if bases else 0,
+        'pct_q30': round(100 * float(per_score[30:].sum()) / bases, 2)
+        if bases else 0}
+
+
+def position_table(quality):
+    """Quality percentiles and mean at every position."""
+    total = quality.sum(axis=1)
+    cum = np.cumsum(quality, axis=1)
+    ret = pd.DataFrame({'position': np.arange(1, len(quality) + 1),
+                        'reads': total})
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p in percentiles:
+            ret['q{}'.format(p)] = (cum < (total * p / 100)[:, None]).sum(axis=1)
+        ret['mean'] = (quality * np.arange(n_scores)).sum(axis=1) / total
+    return ret[ret['reads'] > 0]
+
+
+def plot(positions, lengths, title, filename):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    directions = list(positions)
+    fig, axes = plt.subplots(2, len(directions), squeeze=False,
+                             figsize=(6 * len(directions), 7), dpi=100)
+    for i, direction in enumerate(directions):
+        df = positions[direction]
+        ax = axes[0][i]
+        ax.fill_between(df['position'], df['q10'], df['q90'], alpha=0.2,
+                        label="10-90%")
+        ax.fill_between(df['position'], df['q25'], df['q75'], alpha=0.4,
+                        label="25-75%")
+        ax.plot(df['position'], df['q50'], label="median")
+        ax.axhline(30, color="grey", linestyle=":")
+        ax.set_ylim(0, 42)
+        ax.set_title(direction)
+        ax.set_xlabel("position")
+        ax.set_ylabel("quality score")
+        ax.legend(loc="lower left")
+        ax = axes[1][i]
+        h = lengths[direction]
+        ax.bar(np.arange(len(h)), h, width=1)
+        ax.set_xlabel("read length")
+        ax.set_ylabel("reads")
+    fig.suptitle(title)
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+@click.command()
+@click.option("-i", "inp", required=True,
+              help="SampleData[PairedEndSequencesWithQuality] artifact.")
+@click.option("--summary", required=True, help="TSV, one row per file.")
+@click.option("--positions", required=True,
+              help="TSV, quality percentiles by position.")
+@click.option("--plot", "plot_file", default=None,
+              help="Figure, format given by the extension.")
+@click.option("--threads", default=1, type=int)
+def read_quality(inp, summary, positions, plot_file, threads):
+    tasks = [(inp,) + m for m in fastq_members(inp)]
+    if not tasks:
+        raise click.ClickException("No fastq files in " + inp)
+    profiling.count(files=len(tasks))
+    with profiling.stage("scan"):
+        if threads > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=threads) as pool:
+                res = list(pool.map(profile_member, tasks, chunksize=1))
+        else:
+            res = list(map(profile_member, tasks))
+
+    rows = []
+    quality = {}
+    lengths = {}
+    for sample_id, direction, q, l in res:
+        rows.append(dict({'sample-id': sample_id, 'direction': direction},
+                         **summarize(q, l)))
+        for total, h in ((quality, q), (lengths, l)):
+            prev = total.get(direction, np.zeros_like(h[:0]))
+            size = max(len(prev), len(h))
+            total[direction] = np.pad(prev, [(0, size - len(prev))] +
+                                      [(0, 0)] * (h.ndim - 1)) + \
+                np.pad(h, [(0, size - len(h))] + [(0, 0)] * (h.ndim - 1))
+    with profiling.stage("write"):
+        pd.DataFrame(rows).to_csv(summary, sep="\t", index=False)
+        tables = {d: position_table(q) for d, q in sorted(quality.items())}
+        pd.concat([df.assign(direction=d) for d, df in tables.items()])[
+            ['direction', 'position', 'reads'] +
+            ['q{}'.format(p) for p in percentiles] + ['mean']
+        ].to_csv(positions, sep="\t", index=False, float_format="%.2f")
+        if plot_file:
+            plot(tables, lengths, inp.split("/")[-1].replace(".qza", ""),
+                 plot_file)
+
+
+if __name__ == "__main__":
+    read_quality()
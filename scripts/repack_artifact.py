@@ -0,0 +1,48 @@
+"""Recompress a ``.qza`` artifact, e.g. a deliverable saved in fast mode.
+
+The members are copied in chunks, in the same order and under the same
+names, deflated at ``--level``. The artifact is not loaded, so QIIME2 is not
+needed.
+"""
+
+import os
+import shutil
+import zipfile
+
+import click
+
+import profiling
+
+
+def repack(source, destination, level=9):
+    tmp = destination + ".tmp"
+    with zipfile.ZipFile(source) as zin, \
+            zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                            compresslevel=level) as zout:
+        for info in zin.infolist():
+            out = zipfile.ZipInfo(info.filename, info.date_time)
+            out.compress_type = zipfile.ZIP_DEFLATED
+            out.external_attr = info.external_attr
+            # ZipFile.open applies compresslevel to names only, not ZipInfo
+            if hasattr(out, "compress_level"):  # Python 3.13+
+                out.compress_level = level
+            else:
+                out._compresslevel = level
+            with zin.open(info) as src, \
+                    zout.open(out, "w", force_zip64=info.file_size
+                              >= zipfile.ZIP64_LIMIT) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp, destination)
+
+
+@click.command()
+@click.option("-i", "source", required=True, type=str)
+@click.option("-o", "destination", required=True, type=str)
+@click.option("--level", default=9, type=click.IntRange(0, 9))
+def repack_artifact(source, destination, level):
+    with profiling.stage("write"):
+        repack(source, destination, level)
+
+
+if __name__ == "__main__":
+    repack_artifact()
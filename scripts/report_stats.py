@@ -1,22 +1,120 @@
+"""PDF report of the DADA2 stats of a cohort.
+
+All the ``+dd_stats.qza`` artifacts are read in one process, straight from
+their zip (``data/stats.tsv``), without QIIME2. The distribution of the
+percentage of input reads kept as non-chimeric is drawn as a vector
+histogram with reportlab, one per artifact, after a table summarising them.
+"""
+
+import io
+import os
+import zipfile
+
 import click
-from reportlab.platypus import SimpleDocTemplate, Image
+import numpy as np
+import pandas as pd
+from reportlab.graphics.shapes import Drawing, Group, Line, Rect, String
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import cm
+from reportlab.platypus import (Paragraph, SimpleDocTemplate, Spacer, Table,
+                                TableStyle)
+
+import profiling
+
+column = 'percentage of input non-chimeric'
+
+
+def read_stats(path):
+    """DADA2 stats of an artifact, indexed by sample id."""
+    with zipfile.ZipFile(path) as z:
+        member = [x for x in z.namelist() if x.endswith("/data/stats.tsv")][0]
+        text = z.read(member).decode()
+    # the second line holds the QIIME2 column types
+    lines = [x for x in text.splitlines() if not x.startswith("#q2:")]
+    return pd.read_csv(io.StringIO("\n".join(lines)), sep="\t", index_col=0)
+
+
+def histogram(values, title, size=12 * cm):
+    """Histogram of percentages as a reportlab drawing."""
+    d = Drawing(size, size)
+    left, bottom, top = 1.6 * cm, 1.4 * cm, 1.0 * cm
+    width, height = size - left - 0.4 * cm, size - bottom - top
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    counts, edges = np.histogram(values, bins="auto") if len(values) \
+        else (np.zeros(0), np.zeros(1))
+    ymax = max(int(counts.max()) if len(counts) else 0, 1)
+    step = max(1, int(np.ceil(ymax / 5)))
+
+    def x(v):
+        return left + width * min(max(v, 0), 100) / 100
+
+    def y(v):
+        return bottom + height * v / (step * np.ceil(ymax / step))
+
+    for c, a, b in zip(counts, edges[:-1], edges[1:]):
+        if c:
+            d.add(Rect(x(a), y(0), x(b) - x(a), y(c) - y(0),
+                       fillColor=colors.HexColor("#4C72B0"),
+                       strokeColor=colors.white, strokeWidth=0.5))
+    d.add(Line(left, bottom, left + width, bottom))
+    d.add(Line(left, bottom, left, bottom + height))
+    for v in range(0, 101, 20):
+        d.add(Line(x(v), bottom, x(v), bottom - 3))
+        d.add(String(x(v), bottom - 12, str(v), fontSize=8,
+                     textAnchor="middle"))
+    for v in range(0, int(step * np.ceil(ymax / step)) + 1, step):
+        d.add(Line(left, y(v), left - 3, y(v)))
+        d.add(String(left - 5, y(v) - 3, str(v), fontSize=8, textAnchor="end"))
+    d.add(String(left + width / 2, 0.2 * cm, column, fontSize=9,
+                 textAnchor="middle"))
+    # vertical label, rotated by 90 degrees
+    d.add(Group(String(0, 0, "Count", fontSize=9, textAnchor="middle"),
+                transform=(0, 1, -1, 0, 0.5 * cm, bottom + height / 2)))
+    d.add(String(left + width / 2, size - 0.6 * cm, title, fontSize=10,
+                 textAnchor="middle"))
+    return d
+
+
+def summary(stats):
+    """One row per artifact: samples and kept reads."""
+    rows = []
+    for title, df in stats.items():
+        pct = df[column].astype(float)
+        rows.append([title, len(df), int(df['input'].sum()),
+                     int(df['non-chimeric'].sum()),
+                     "{:.1f}".format(pct.median()) if len(df) else "",
+                     int((pct < 50).sum())])
+    return [['artifact', 'samples', 'input reads', 'non-chimeric reads',
+             'median %', 'samples < 50%']] + rows
 
 
 @click.command()
-@click.option("--inp")
+@click.option("--inp", help="Comma separated +dd_stats.qza artifacts.")
 @click.option("--outp")
 def make_report(inp, outp):
-    story = []
+    paths = [x for x in inp.split(",") if x]
+    with profiling.stage("load"):
+        stats = {os.path.basename(p).replace("+dd_stats.qza", ""): read_stats(p)
+                 for p in paths}
+    profiling.count(artifacts=len(stats),
+                    samples=sum(len(df) for df in stats.values()))
+    styles = getSampleStyleSheet()
+    story = [Paragraph("DADA2 stats", styles['Title']),
+             Table(summary(stats), repeatRows=1, style=TableStyle([
+                 ('FONTSIZE', (0, 0), (-1, -1), 7),
+                 ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+                 ('GRID', (0, 0), (-1, -1), 0.25, colors.grey)])),
+             Spacer(1, 12)]
+    for title, df in stats.items():
+        story.append(histogram(df[column], title))
     doc = SimpleDocTemplate(outp,pagesize=letter,
                         rightMargin=72,leftMargin=72,
                         topMargin=72,bottomMargin=18)
-    for plot_file in inp.split(","):
-
-            story.append(Image(plot_file, 12*cm, 12*cm))
-
-    doc.build(story)
+    with profiling.stage("write"):
+        doc.build(story)
 
 if __name__ == "__main__":
     make_report()
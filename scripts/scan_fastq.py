@@ -0,0 +1,202 @@
+"""Pre-flight check of the fastq files of a cohort.
+
+The R1 and R2 files of every sample, paired as in
+``create_manifest_file.py``, are streamed together in parallel worker
+processes. For each sample the index records:
+
+- the number of reads of each file, and whether the read names of the two
+  files agree record by record,
+- the minimum, mean and maximum read length and the mean quality,
+- a ``status``: ``ok``, ``empty``, ``truncated`` (unreadable or incomplete
+  file), ``count_mismatch`` or ``name_mismatch``, with a message.
+
+The index is a TSV keyed by the path, size and modification time of both
+files; given the previous index with ``--cache``, only the samples whose
+files changed are scanned again.
+"""
+
+import gzip
+import os
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import pandas as pd
+
+import profiling
+from create_manifest_file import find_pairs
+
+key_columns = ['forward-absolute-filepath', 'forward-size', 'forward-mtime',
+               'reverse-absolute-filepath', 'reverse-size', 'reverse-mtime']
+
+stat_columns = ['reads', 'min_length', 'mean_length', 'max_length', 'mean_quality']
+
+
+class ReadStats:
+    """Length and quality summary of the reads of one file."""
+
+    def __init__(self):
+        self.reads = 0
+        self.min_length = None
+        self.max_length = 0
+        self.bases = 0
+        self.quality = 0
+        self._pending = []
+
+    def add(self, length, qual):
+        self.reads += 1
+        self.bases += length
+        self.max_length = max(self.max_length, length)
+        self.min_length = length if self.min_length is None \
+            else min(self.min_length, length)
+        self._pending.append(qual)
+        if len(self._pending) >= 10000:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            q = np.frombuffer(b"".join(self._pending), dtype=np.uint8)
+            self.quality += int(q.sum()) - 33 * len(q)
+            self._pending = []
+
+    def summary(self):
+        self._flush()
+        return {
+            'reads': self.reads,
+            'min_length': self.min_length or 0,
+            'mean_length': round(self.bases / self.reads, 2) if self.reads else 0,
+            'max_length': self.max_length,
+            'mean_quality': round(self.quality / self.bases, 2) if self.bases else 0}
+
+
+def read_name(header):
+    """Name of a read without the /1 or /2 mate suffix."""
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b""
+    if name.endswith((b"/1", b"/2")):
+        name = name[:-2]
+    return name
+
+
+def records(path):
+    """Yield ``(name, length, quality)`` of the reads of a fastq file."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        n = 0
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            seq = f.readline().rstrip(b"\r\n")
+            plus = f.readline()
+            qual = f.readline().rstrip(b"\r\n")
+            if not header.startswith(b"@") or not plus.startswith(b"+") \
+                    or len(seq) != len(qual):
+                raise ValueError("incomplete or malformed record after "
+                                 "{} reads".format(n))
+            n += 1
+            yield read_name(header), len(seq), qual
+
+
+def scan_pair(fwd, rev):
+    """Scan the two files of a sample, return the columns of the index."""
+    stats = (ReadStats(), ReadStats())
+    status, message = "ok", ""
+    try:
+        it = (records(fwd), records(rev))
+        ended = [False, False]
+        while not all(ended):
+            recs = []
+            for i in (0, 1):
+                rec = None
+                if not ended[i]:
+                    rec = next(it[i], None)
+                    ended[i] = rec is None
+                recs.append(rec)
+            for s, rec in zip(stats, recs):
+                if rec is not None:
+                    s.add(rec[1], rec[2])
+            if status == "ok" and None not in recs and recs[0][0] != recs[1][0]:
+                status = "name_mismatch"
+                message = "read {}: {} and {}".format(
+                    stats[0].reads, recs[0][0].decode(errors="replace"),
+                    recs[1][0].decode(errors="replace"))
+    except (EOFError, OSError, ValueError, zlib.error) as e:
+        status, message = "truncated", str(e)
+    ret = {}
+    for prefix, s in zip(("forward", "reverse"), stats):
+        ret.update({prefix + "-" + k: v for k, v in s.summary().items()})
+    if status in ("ok", "name_mismatch"):
+        if ret['forward-reads'] != ret['reverse-reads']:
+            status = "count_mismatch"
+            message = "{} and {} reads".format(ret['forward-reads'],
+                                                ret['reverse-reads'])
+        elif ret['forward-reads'] == 0:
+            status = "empty"
+    ret['status'] = status
+    ret['message'] = message
+    return ret
+
+
+def file_keys(pairs):
+    """Paths, sizes and modification times identifying the scanned files."""
+    df = pd.DataFrame(pairs)
+    for prefix in ("forward", "reverse"):
+        st = [os.stat(p) for p in df[prefix + "-absolute-filepath"]]
+        df[prefix + "-size"] = [x.st_size for x in st]
+        df[prefix + "-mtime"] = [x.st_mtime_ns for x in st]
+    return df
+
+
+@click.command()
+@click.option("-i", "input_folder", required=True, type=str)
+@click.option("-o", "output", required=True, type=str)
+@click.option("--cache", default=None, type=str,
+              help="Previous index, kept up to date, to skip unchanged files.")
+@click.option("--threads", default=1, type=int)
+def scan_fastq(input_folder, output, cache, threads):
+    df = file_keys(find_pairs(input_folder))
+    known = None
+    if cache and os.path.exists(cache):
+        known = pd.read_csv(cache, sep="\t", dtype={'sample-id': str},
+                            keep_default_na=False)
+        known = known.drop_duplicates(key_columns).set_index(key_columns)
+    todo = df.set_index(key_columns).index
+    if known is not None:
+        todo = todo.difference(known.index)
+    todo = df[df.set_index(key_columns).index.isin(todo)]
+    print("{} of {} samples to scan".format(len(todo), len(df)))
+    profiling.count(samples=len(df), scanned=len(todo))
+
+    with profiling.stage("scan"):
+        args = (list(todo["forward-absolute-filepath"]),
+                list(todo["reverse-absolute-filepath"]))
+        if threads > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=threads) as pool:
+                res = list(pool.map(scan_pair, *args, chunksize=1))
+        else:
+            res = list(map(scan_pair, *args))
+    result_columns = ['status', 'message'] + [
+        "{}-{}".format(p, c) for p in ("forward", "reverse")
+        for c in stat_columns]
+    # explicit columns, nothing may have been scanned
+    scanned = pd.DataFrame(res, index=todo.set_index(key_columns).index,
+                           columns=result_columns)
+    if known is not None:
+        scanned = pd.concat([known.drop(columns="sample-id"), scanned])
+    index = df.join(scanned, on=key_columns)
+    index = index[['sample-id'] + key_columns + result_columns]
+    index.to_csv(output, sep="\t", index=False)
+    if cache:
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        shutil.copyfile(output, cache + ".tmp")
+        os.replace(cache + ".tmp", cache)
+    bad = index[index['status'] != "ok"]
+    for _, row in bad.iterrows():
+        print("Bad sample {}: {} {}".format(row['sample-id'], row['status'],
+                                            row['message']))
+
+
+if __name__ == "__main__":
+    scan_fastq()
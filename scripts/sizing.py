@@ -0,0 +1,250 @@
+"""Threads, memory and runtime of the Snakefile rules, sized by cohort.
+
+The Snakefile declares for the heavy rules::
+
+    threads: sizing.threads("dada2")
+    resources:
+         mem_mb=sizing.mem_mb("dada2"),
+         runtime=sizing.runtime("dada2")
+
+The callables are evaluated by Snakemake for every job from two features:
+the number of samples of the cohort (rows of
+``results/{cohort}/{cohort}_manifest.tsv``, summed over the cohorts of a
+merged cohort) and the size of the input files in MB. A missing manifest
+counts as ``default_samples`` samples, and a missing input as 0 MB. A job
+on one of ``{n}`` shards of a cohort (``dada2_shard``) counts its share of
+the samples, as recorded by its script. For every rule:
+
+- threads = ``samples / samples_per_thread`` or ``input_mb / mb_per_thread``,
+  whichever is larger, rounded up and clamped to ``[min_threads,
+  max_threads]``,
+- mem_mb = ``mem_base + mem_per_mb * input_mb + mem_per_sample * samples``,
+  multiplied by the attempt number when a job is restarted,
+- runtime (minutes) = ``runtime_base + runtime_per_mb * input_mb +
+  runtime_per_sample * samples``.
+
+The coefficients of ``default_model`` are rough; a JSON file given with
+``--config sizing=<file>`` overrides them rule by rule. It is written by::
+
+    python scripts/sizing.py -o sizing.json results/*/*_profile.tsv
+
+which fits the memory and runtime of every rule to the job tables of the
+``profile_report`` rule (nonnegative least squares).
+"""
+
+import json
+import math
+import os
+
+# rough coefficients, see the module docstring
+default_model = {
+    'default': {'min_threads': 1, 'max_threads': 1,
+                'mem_base': 1000, 'mem_per_mb': 1, 'mem_per_sample': 0,
+                'runtime_base': 10, 'runtime_per_mb': 0.01,
+                'runtime_per_sample': 0},
+    'qza_fastqc': {'min_threads': 1, 'max_threads': 20, 'samples_per_thread': 5,
+                   'mem_base': 500, 'mem_per_mb': 0, 'mem_per_sample': 0,
+                   'runtime_per_mb': 0.02},
+    'read_quality': {'max_threads': 8, 'samples_per_thread': 10,
+                     'mem_base': 500, 'mem_per_mb': 0, 'mem_per_sample': 1,
+                     'runtime_per_mb': 0.005},
+    'fastq_index': {'max_threads': 8, 'samples_per_thread': 10,
+                    'mem_base': 500, 'mem_per_mb': 0, 'mem_per_sample': 1},
+    'import_data': {'max_threads': 8, 'samples_per_thread': 20,
+                    'mem_base': 2000, 'mem_per_mb': 0, 'mem_per_sample': 2,
+                    'runtime_per_sample': 0.05},
+    'trim': {'max_threads': 30, 'samples_per_thread': 4,
+             'mem_base': 2000, 'mem_per_mb': 0.5, 'mem_per_sample': 10,
+             'runtime_per_mb': 0.02},
+    'dada2': {'max_threads': 30, 'samples_per_thread': 10,
+              'mem_base': 4000, 'mem_per_mb': 2, 'mem_per_sample': 20,
+              'runtime_base': 15, 'runtime_per_mb': 0.1,
+              'runtime_per_sample': 0.2},
+    'taxonomy': {'max_threads': 30, 'mb_per_thread': 0.5,
+                 'mem_base': 16000, 'mem_per_mb': 20, 'mem_per_sample': 0,
+                 'runtime_base': 20, 'runtime_per_mb': 2},
+    'core_metrics': {'max_threads': 30, 'samples_per_thread': 50,
+                     'mem_base': 2000, 'mem_per_mb': 5, 'mem_per_sample': 1,
+                     'runtime_per_sample': 0.05},
+    'diversity': {'max_threads': 8, 'samples_per_thread': 200,
+                  'mem_base': 1000, 'mem_per_mb': 5, 'mem_per_sample': 0.5},
+}
+
+
+def cohort_names(cohort):
+    """Cohorts of a merged cohort: listed in cohorts/{cohort}.txt, or joined with -"""
+    list_file = os.path.join("cohorts", cohort + ".txt")
+    if os.path.exists(list_file):
+        with open(list_file) as f:
+            return [x.strip() for x in f if x.strip() and not x.startswith("#")]
+    return cohort.split("-")
+
+
+class Sizing:
+    """Resource callables of the Snakefile rules.
+
+    Parameters
+    ----------
+    model : str, optional
+        JSON file of coefficients by rule, merged over ``default_model``.
+    default_samples : int
+        Number of samples assumed for a cohort without manifest yet.
+    """
+
+    def __init__(self, model=None, default_samples=100):
+        self.model = {k: dict(v) for k, v in default_model.items()}
+        if model:
+            with open(model) as f:
+                for rule, coefs in json.load(f).items():
+                    self.model.setdefault(rule, {}).update(coefs)
+        self.default_samples = default_samples
+        self._samples = {}
+
+    def coefs(self, rule):
+        ret = dict(self.model['default'])
+        ret.update(self.model.get(rule, {}))
+        return ret
+
+    def samples(self, cohort):
+        """Number of samples of a cohort, read from its manifest."""
+        total = 0
+        for name in cohort_names(cohort):
+            path = os.path.join("results", name, name + "_manifest.tsv")
+            try:
+                key = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                total += self.default_samples
+                continue
+            if key not in self._samples:
+                with open(path) as f:
+                    self._samples[key] = max(0, sum(1 for _ in f) - 1)
+            total += self._samples[key]
+        return total
+
+    def features(self, wildcards, input):
+        cohort = wildcards.get("cohort") or wildcards.get("cohorts")
+        samples = self.samples(cohort) if cohort else self.default_samples
+        if wildcards.get("n"):
+            samples = math.ceil(samples / int(wildcards.get("n")))
+        size = 0
+        for path in input:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return samples, size / 2 ** 20
+
+    def estimate(self, rule, samples, input_mb, attempt=1):
+        """``(threads, mem_mb, runtime)`` of a job."""
+        c = self.coefs(rule)
+        need = max(samples / c['samples_per_thread']
+                   if c.get('samples_per_thread') else 0,
+                   input_mb / c['mb_per_thread']
+                   if c.get('mb_per_thread') else 0)
+        threads = min(max(math.ceil(need), c['min_threads']), c['max_threads'])
+        mem = c['mem_base'] + c['mem_per_mb'] * input_mb + \
+            c['mem_per_sample'] * samples
+        runtime = c['runtime_base'] + c['runtime_per_mb'] * input_mb + \
+            c['runtime_per_sample'] * samples
+        return int(threads), int(math.ceil(mem * attempt)), \
+            int(math.ceil(runtime))
+
+    def threads(self, rule):
+        def threads(wildcards, input):
+            return self.estimate(rule, *self.features(wildcards, input))[0]
+        return threads
+
+    def mem_mb(self, rule):
+        def mem_mb(wildcards, input, attempt):
+            return self.estimate(rule, *self.features(wildcards, input),
+                                 attempt=attempt)[1]
+        return mem_mb
+
+    def runtime(self, rule):
+        def runtime(wildcards, input):
+            return self.estimate(rule, *self.features(wildcards, input))[2]
+        return runtime
+
+
+def fit(x, y):
+    """Nonnegative least squares coefficients of ``y ~ x``."""
+    import numpy as np
+    from scipy.optimize import nnls
+    return nnls(np.asarray(x, dtype=float), np.asarray(y, dtype=float))[0]
+
+
+def calibrate(tables, rules=None):
+    """Memory and runtime coefficients of every rule from profile tables.
+
+    Parameters
+    ----------
+    tables : list of str
+        Job tables written by ``profile_report.py``: rule, wall_s,
+        peak_rss_mb, input_mb and counts (with ``samples=``).
+    rules : dict, optional
+        Name in the tables -> name in the model, e.g. ``trim_fastp`` ->
+        ``trim``.
+
+    Returns
+    -------
+    dict
+        Rule -> coefficients, for the rules with at least 3 jobs with a
+        script record.
+    """
+    import pandas as pd
+    df = pd.concat([pd.read_csv(t, sep="\t") for t in tables])
+    df = df.dropna(subset=['peak_rss_mb', 'input_mb'])
+    df['samples'] = df['counts'].fillna("").str.extract(
+        r"(?:^|;)samples=(\d+)", expand=False).astype(float).fillna(0)
+    df['rule'] = df['rule'].map(lambda r: (rules or {}).get(r, r))
+    ret = {}
+    for rule, jobs in df.groupby('rule'):
+        if len(jobs) < 3:
+            continue
+        x = pd.DataFrame({'base': 1.0, 'mb': jobs['input_mb'],
+                          'sample': jobs['samples']})
+        mem = fit(x.values, jobs['peak_rss_mb'].values)
+        runtime = fit(x.values, jobs['wall_s'].values / 60)
+        ret[rule] = {
+            'mem_base': round(float(mem[0]), 1),
+            'mem_per_mb': round(float(mem[1]), 4),
+            'mem_per_sample': round(float(mem[2]), 4),
+            'runtime_base': round(float(runtime[0]), 2),
+            'runtime_per_mb': round(float(runtime[1]), 5),
+            'runtime_per_sample': round(float(runtime[2]), 5)}
+    return ret
+
+
+# rules of the Snakefile sharing a model
+rule_models = {'trim_fastp': 'trim', 'trim_bbduk': 'trim', 'trim_chain': 'trim',
+               'dada2_shard': 'dada2', 'alpha_diversity': 'diversity',
+               'beta_diversity': 'diversity', 'rarefaction_sweep': 'diversity'}
+
+
+if __name__ == "__main__":
+    # imported here, the Snakefile imports this module from its own environment
+    import click
+
+    @click.command()
+    @click.option("-o", "output", required=True, help="JSON model.")
+    @click.option("--headroom", default=1.2, type=float,
+                  help="Factor applied to the fitted memory.")
+    @click.argument("tables", nargs=-1, required=True)
+    def main(output, headroom, tables):
+        """Fit the model to the job tables of profile_report.py."""
+        model = calibrate(tables, rule_models)
+        for coefs in model.values():
+            for k in ('mem_base', 'mem_per_mb', 'mem_per_sample'):
+                coefs[k] = round(coefs[k] * headroom, 4)
+        previous = {}
+        if os.path.exists(output):
+            with open(output) as f:
+                previous = json.load(f)
+        for rule, coefs in model.items():
+            previous.setdefault(rule, {}).update(coefs)
+        with open(output, "w") as f:
+            json.dump(previous, f, indent=1, sort_keys=True)
+        for rule in sorted(model):
+            print(rule, model[rule])
+
+    main()
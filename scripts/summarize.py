@@ -1,29 +1,164 @@
-import click
-import os
+"""Merge taxonomy reports into one file.
+
+The reports (tab separated: percent, cumulative count, count, rank, taxonomy
+id and name; the first line is taken as a header) are parsed in parallel
+worker processes and written as they come, in the order given, so memory
+does not grow with the number of reports. The layout is chosen by the
+extension of ``--outp``:
+
+- ``.tsv``, ``.csv``: long-form table, one row per report line with the
+  report file name as first column,
+- ``.parquet``: the same table, the file, rank and name columns
+  dictionary-encoded, one row group per batch of reports (needs pyarrow),
+- ``.ndjson``, ``.jsonl``: one JSON object per report line,
+- ``.json``: the original layout, ``{file: {line: {column: value}}}``
+  indented by 4 spaces.
+"""
+
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import click
 import pandas as pd
 
-@click.command()
-@click.option("--files")
-@click.option("--outp")
-def summarize(files, outp):
-    files = files.split(",")
-    result = {}
-    for file in files:
-        _df = pd.read_csv(file, sep="\t")
-        _df.columns=['percent', "count_accu", "count", "TL", "TID", "Taxonomy"]
-        _df['index'] = _df.index 
-        _df = _df.iloc[:,[6,3,4,5,2,1,0]]
-        _df['Taxonomy'] = _df['Taxonomy'].apply(lambda x: x.strip())
-        result[file] = _df.to_dict(orient="index")
+import profiling
+
+columns = ['index', 'TL', 'TID', 'Taxonomy', 'count', 'count_accu', 'percent']
+
+
+def read_report(file):
+    """Lines of a report, with the columns of ``columns``."""
+    df = pd.read_csv(file, sep="\t")
+    df.columns = ['percent', "count_accu", "count", "TL", "TID", "Taxonomy"]
+    df['index'] = df.index
+    df['Taxonomy'] = df['Taxonomy'].str.strip()
+    return df[columns]
+
+
+def batches(files, threads, batch_size):
+    """Yield ``(file, report)`` in order, parsing ahead in parallel."""
+    if threads <= 1:
+        for file in files:
+            yield file, read_report(file)
+        return
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        for i in range(0, len(files), batch_size):
+            chunk = files[i:i + batch_size]
+            yield from zip(chunk, pool.map(read_report, chunk))
 
 
+class LegacyJson:
+    """``{file: {line: {column: value}}}`` written one report at a time."""
+
+    def __init__(self, outp):
+        self.f = open(outp, "w")
+        self.first = True
+
+    def write(self, file, df):
+        # same text as json.dump of the whole dict with indent=4
+        item = json.dumps({file: df.to_dict(orient="index")}, indent=4)[2:-2]
+        self.f.write(("{\n" if self.first else ",\n") + item)
+        self.first = False
+
+    def close(self):
+        self.f.write("{}" if self.first else "\n}")
+        self.f.close()
+
+
+class LongForm:
+    """Long-form table written one batch of reports at a time."""
+
+    def __init__(self, outp, batch_size):
+        self.outp = outp
+        self.batch_size = batch_size
+        self.pending = []
+        self.parquet = None
+        self.header = True
+        if outp.endswith(".parquet"):
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise click.ClickException(
+                    "Parquet output needs pyarrow, use .tsv or .ndjson")
+        else:
+            open(outp, "w").close()
+
+    def write(self, file, df):
+        self.pending.append(df.assign(file=file)[['file'] + columns])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        df = pd.concat(self.pending, ignore_index=True)
+        self.pending = []
+        if self.outp.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.parquet is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self.parquet = pq.ParquetWriter(
+                    self.outp, table.schema,
+                    use_dictionary=['file', 'TL', 'Taxonomy'])
+            else:
+                table = pa.Table.from_pandas(df, schema=self.parquet.schema,
+                                             preserve_index=False)
+            self.parquet.write_table(table)
+        elif self.outp.endswith((".ndjson", ".jsonl")):
+            with open(self.outp, "a") as f:
+                f.write(df.to_json(orient="records", lines=True).rstrip("\n")
+                        + "\n")
+        else:
+            df.to_csv(self.outp, mode="a", header=self.header, index=False,
+                      sep="," if self.outp.endswith(".csv") else "\t")
+        self.header = False
+
+    def close(self):
+        self.flush()
+        if self.parquet is not None:
+            self.parquet.close()
+
+
+@click.command()
+@click.option("--files", default="", help="Comma separated reports.")
+@click.option("--file-list", default=None,
+              help="File listing the reports, one per line.")
+@click.option("--outp", required=True,
+              help="Output, .tsv, .csv, .parquet, .ndjson or .json (original "
+                   "layout).")
+@click.option("--threads", default=1, type=int)
+@click.option("--batch-size", default=64, type=int,
+              help="Reports parsed and written at a time.")
+def summarize(files, file_list, outp, threads, batch_size):
+    files = [x for x in files.split(",") if x]
+    if file_list:
+        with open(file_list) as f:
+            files += [x.strip() for x in f if x.strip()]
+    # a report given twice is written once, as in a dict
+    files = list(dict.fromkeys(files))
+    if not files:
+        raise click.UsageError("No report given, use --files or --file-list")
+
     if os.path.isfile(outp):
         raise Exception(outp, "File exists")
+    if outp.endswith(".json"):
+        out = LegacyJson(outp)
     else:
-        with open(outp, "w") as f:
-            json.dump(result, f, indent=4)
+        out = LongForm(outp, batch_size)
+    profiling.count(reports=len(files))
+    try:
+        with profiling.stage("merge"):
+            for file, df in batches(files, threads, batch_size):
+                out.write(file, df)
+    except BaseException:
+        out.close()
+        if os.path.exists(outp):
+            os.remove(outp)
+        raise
+    out.close()
 
 
 if __name__ == "__main__":
-    summarize()
\ No newline at end of file
+    summarize()
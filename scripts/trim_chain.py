@@ -0,0 +1,100 @@
+"""Apply a chain of trimming steps to every sample in a single pass.
+
+The chain uses the same naming as the Snakefile targets, e.g.
+``fp-f17-r21+bb-t18`` crops primers with fastp and then quality trims with
+bbduk. Each sample is run through all the steps using uncompressed scratch
+files which are removed as soon as the sample is finished, so only the final
+artifact is written.
+"""
+
+import os
+import re
+import tempfile
+from functools import partial
+import click
+import profiling
+from common import save_artifact, trim_per_sample
+from fastp import fastp_pair
+from bbduk import bbduk_pair
+from trimmomatic import trimmomatic_pair
+
+steps = [
+    (re.compile(r"^fp-f(\d+)-r(\d+)$"),
+     lambda m: partial(fastp_pair, len1=int(m.group(1)), len2=int(m.group(2)))),
+    (re.compile(r"^bb-t(\d+)$"),
+     lambda m: partial(bbduk_pair, trimming_threshold=int(m.group(1)))),
+    (re.compile(r"^tm-w(\d+)-q(\d+)(?:-h(\d+))?$"),
+     lambda m: partial(trimmomatic_pair, sliding_window=int(m.group(1)),
+                       trimming_threshold=int(m.group(2)),
+                       headcrop=int(m.group(3) or 0))),
+]
+
+
+def parse_chain(chain):
+    """Convert a ``+`` separated chain name to a list of trimming steps.
+
+    Parameters
+    ----------
+    chain : str
+        Steps named as in the Snakefile targets: ``fp-f{len1}-r{len2}``
+        (primer crop with fastp), ``bb-t{threshold}`` (quality trimming with
+        bbduk) and ``tm-w{window}-q{threshold}[-h{headcrop}]`` (sliding window
+        trimming with trimmomatic).
+
+    Returns
+    -------
+    list
+        Callables with the signature of ``fastp_pair``.
+    """
+    ret = []
+    for name in chain.split("+"):
+        for pattern, make_step in steps:
+            m = pattern.match(name)
+            if m:
+                ret.append(make_step(m))
+                break
+        else:
+            raise click.BadParameter("Unknown trimming step: " + name)
+    return ret
+
+
+def chain_pair(chain, fwd_fp, rev_fp, p1, p2, threads=1):
+    """Run one pair of reads through all the steps of a chain."""
+    with tempfile.TemporaryDirectory() as scratch:
+        src = (fwd_fp, rev_fp)
+        for i, step in enumerate(chain):
+            if i == len(chain) - 1:
+                dst = (p1, p2)
+            else:
+                dst = (os.path.join(scratch, "{}_R1.fastq".format(i)),
+                       os.path.join(scratch, "{}_R2.fastq".format(i)))
+            step(*src, *dst, threads)
+            if i > 0:
+                os.remove(src[0])
+                os.remove(src[1])
+            src = dst
+
+
+def trim_chain(artifact, chain, threads=1, store=None):
+    return trim_per_sample(artifact, partial(chain_pair, parse_chain(chain)),
+                           threads, store)
+
+
+@click.command()
+@click.option("-i", "file_name", required=True, type=str)
+@click.option("-c", "chain", required=True, type=str,
+              help="Trimming steps, e.g. fp-f17-r21+bb-t18")
+@click.option("-o", "output", required=True, type=str)
+@click.option("-t", "threads", default=1, type=int,
+              help="Total number of threads shared by the per-sample jobs.")
+@click.option("--store", default=None, type=str,
+              help="Folder keeping the trimmed reads of every sample; only "
+                   "new or changed samples are trimmed.")
+def analyze(file_name, chain, output, threads, store):
+    parse_chain(chain)
+    trimmed = trim_chain(file_name, chain, threads, store)
+    with profiling.stage("write"):
+        save_artifact(trimmed, output)
+
+if __name__ == "__main__":
+    analyze()
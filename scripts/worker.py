@@ -0,0 +1,250 @@
+"""Warm worker running the helper scripts without interpreter start-up cost.
+
+Start the worker once, in the QIIME2 conda environment::
+
+    python scripts/worker.py serve &
+
+It imports qiime2, the plugins, biom, skbio and pandas once and listens on
+the Unix socket ``$SNAQ_WORKER_SOCKET`` (default ``temp/snaq_worker.sock``).
+The rules run their scripts through the client::
+
+    python scripts/worker.py run scripts/alpha_diversity.py --inp ...
+
+Every job is run in a process forked from the worker, with the working
+directory, environment and standard streams of the client, so the jobs do
+not share any state. When no worker is listening the client executes the
+script itself.
+
+The job runs in its own process group. SIGTERM, SIGINT and SIGHUP received
+by the client are forwarded to it, and it is killed when the client goes
+away, so a job cancelled by Snakemake does not keep writing its outputs.
+
+The client only imports the standard library and click.
+"""
+
+import array
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+import click
+
+warm_modules = [
+    "numpy", "pandas", "scipy.sparse", "scipy.spatial.distance", "biom",
+    "skbio", "qiime2", "qiime2.plugins", "q2_types.per_sample_sequences",
+    "qiime2.plugins.diversity.pipelines", "qiime2.plugins.feature_classifier",
+    "matplotlib.pylab", "seaborn",
+]
+
+header = struct.Struct("!Q")
+forwarded_signals = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+# seconds between SIGTERM and SIGKILL when the client is gone
+kill_grace = 10
+
+
+def socket_path():
+    return os.environ.get("SNAQ_WORKER_SOCKET", "temp/snaq_worker.sock")
+
+
+def _recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the client")
+        data += chunk
+    return data
+
+
+def _run_job(request, fds):
+    """Body of the job process, never returns."""
+    code = 1
+    try:
+        os.setpgid(0, 0)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        script = os.path.abspath(request["script"])
+        sys.argv = [script] + request["args"]
+        sys.path[0] = os.path.dirname(script)
+        import runpy
+        runpy.run_path(script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        # os._exit skips the atexit handlers of the script
+        if "profiling" in sys.modules:
+            sys.modules["profiling"].write_record()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _kill_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _wait_job(conn, pid):
+    """Wait for the job, applying the cancel messages of the client.
+
+    Returns the wait status, or None when the client went away, in which
+    case the process group of the job is killed.
+    """
+    buffered = b""
+    while True:
+        done, wait_status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return wait_status
+        if not select.select([conn], [], [], 0.2)[0]:
+            continue
+        chunk = conn.recv(4096)
+        if not chunk:
+            _kill_group(pid, signal.SIGTERM)
+            deadline = time.monotonic() + kill_grace
+            while not os.waitpid(pid, os.WNOHANG)[0]:
+                if time.monotonic() > deadline:
+                    _kill_group(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.1)
+            return None
+        buffered += chunk
+        *messages, buffered = buffered.split(b"\n")
+        for message in messages:
+            _kill_group(pid, json.loads(message.decode())["cancel"])
+
+
+def _handle(conn):
+    """Run one request and report its exit status, never returns."""
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    status = 1
+    try:
+        fds = array.array("i")
+        msg, ancdata, _, _ = conn.recvmsg(
+            header.size, socket.CMSG_LEN(3 * fds.itemsize))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        size, = header.unpack(msg + _recv_exactly(conn, header.size - len(msg)))
+        request = json.loads(_recv_exactly(conn, size).decode())
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            _run_job(request, list(fds))
+        try:
+            # also set by the job, whichever runs first
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        for fd in fds:
+            os.close(fd)
+        wait_status = _wait_job(conn, pid)
+        if wait_status is None:
+            os._exit(0)
+        if os.WIFEXITED(wait_status):
+            status = os.WEXITSTATUS(wait_status)
+        else:
+            status = 128 + os.WTERMSIG(wait_status)
+    finally:
+        try:
+            conn.sendall((json.dumps({"status": status}) + "\n").encode())
+        finally:
+            os._exit(0)
+
+
+@click.group()
+def worker():
+    pass
+
+
+@worker.command()
+@click.option("--socket", "path", default=None, type=str,
+              help="Unix socket, $SNAQ_WORKER_SOCKET by default.")
+def serve(path):
+    """Import the heavy modules once and serve jobs."""
+    import importlib
+    import matplotlib
+    matplotlib.use("Agg")
+    for module in warm_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print("Not preloaded:", module, e, file=sys.stderr)
+    if "qiime2" in sys.modules:
+        # loads the plugins and registers their transformers
+        from qiime2.sdk import PluginManager
+        PluginManager()
+
+    path = path or socket_path()
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+    # the request handlers are not waited for
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print("Snaq worker listening on", path)
+    try:
+        while True:
+            conn, _ = server.accept()
+            if os.fork() == 0:
+                server.close()
+                _handle(conn)
+            conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+
+@worker.command(context_settings=dict(ignore_unknown_options=True,
+                                      allow_interspersed_args=False))
+@click.argument("script")
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def run(script, args):
+    """Run SCRIPT with ARGS in the worker, or directly without a worker."""
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socket_path())
+    except OSError:
+        os.execv(sys.executable, [sys.executable, script] + list(args))
+
+    request = json.dumps({"script": script, "args": list(args),
+                          "cwd": os.getcwd(), "env": dict(os.environ)}).encode()
+    conn.sendmsg([header.pack(len(request))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                   array.array("i", [0, 1, 2]))])
+    conn.sendall(request)
+
+    def cancel(signum, frame):
+        conn.sendall((json.dumps({"cancel": signum}) + "\n").encode())
+    for sig in forwarded_signals:
+        signal.signal(sig, cancel)
+    reply = b""
+    while not reply.endswith(b"\n"):
+        chunk = conn.recv(4096)
+        if not chunk:
+            sys.exit("The worker exited before reporting the job status")
+        reply += chunk
+    sys.exit(json.loads(reply.decode())["status"])
+
+
+if __name__ == "__main__":
+    worker()